@@ -0,0 +1,142 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from fastapi import HTTPException, Depends
+from securite import jwt_required
+from pool_stats import pool_stats
+from metrics import ADMISSION_REJECTED
+
+#----------------------------------- Contrôle d'admission des demandes de masquage ----------------------------------------
+# Sous surcharge, mieux vaut refuser tout de suite (503 + Retry-After) que laisser chaque requête occuper une connexion
+# et finir en timeout. Avant d'entrer dans le handler, une requête doit obtenir une place parmi max_in_flight :
+#   - places occupées : attente courte dans une file à priorité (admin avant user), refus si la file est pleine
+#     ou si l'attente dépasse queue_timeout ;
+#   - base lente : la limite effective baisse en proportion de la latence moyenne (EWMA) au-delà de la cible,
+#     sans descendre sous 1 (les requêtes admises continuent de mesurer la latence réelle).
+# Pool proxy épuisé (dernier instantané de pool_stats, rafraîchi en tâche de fond) : check_pool est appelé par le
+# handler juste avant d'allouer, après les recherches d'idempotence. Une requête rejouée ou un couple déjà masqué,
+# qui n'ont pas besoin d'un nouveau numéro, restent servis pendant l'épuisement.
+# Les lots (/mask/calls, jusqu'à des milliers d'appels par requête) ont leur propre contrôleur : leur durée ne doit
+# pas faire baisser la limite des appels unitaires alors que la base répond normalement.
+
+PRIORITIES = {"admin": 0}  # scope -> priorité (plus petit = servi d'abord) ; les autres scopes ont la priorité 1
+
+
+def priority_of(token: dict) -> int:
+    return PRIORITIES.get(token.get("scope"), 1)
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight: int | None = None, max_queue: int | None = None,
+                 queue_timeout: float | None = None, target_latency: float | None = None):
+        self.max_in_flight = max_in_flight or int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("ADMISSION_MAX_QUEUE", "128"))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.25"))
+        self.target_latency = target_latency or float(os.getenv("ADMISSION_TARGET_LATENCY", "0.5"))
+        self.pool_reserve = int(os.getenv("ADMISSION_POOL_RESERVE", "0"))  # numéros gardés pour les admins
+        self.retry_after = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+        self.pool_retry_after = int(os.getenv("ADMISSION_POOL_RETRY_AFTER", "30"))
+        self.in_flight = 0
+        self.queued = 0
+        self.latency = 0.0       # EWMA du temps de traitement d'une requête admise (s)
+        self.queue_wait = 0.0    # EWMA de l'attente dans la file (s)
+        self._waiters = []       # tas (priorité, ordre d'arrivée, future)
+        self._order = itertools.count()
+        self._refresh_task: asyncio.Task | None = None
+
+    @property
+    def limit(self) -> int:
+        """Nombre de places effectif : max_in_flight, réduit si la latence moyenne dépasse la cible"""
+        if self.latency <= self.target_latency:
+            return self.max_in_flight
+        return max(1, int(self.max_in_flight * self.target_latency / self.latency))
+
+    def _reject(self, reason: str, retry_after: float):
+        ADMISSION_REJECTED.inc(reason)
+        raise HTTPException(
+            status_code=503,
+            detail="Service saturé. Veuillez réessayer plus tard",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    @staticmethod
+    async def _refresh_pool_stats():
+        try:
+            await pool_stats.get()
+        except Exception as e:
+            # Sans instantané récent, on garde le dernier connu (les autres garde-fous restent actifs)
+            logging.warning(f"Statistiques du pool indisponibles pour l'admission : {str(e)}")
+
+    def check_pool(self, priority: int):
+        """Lève une 503 (Retry-After) si le pool proxy est épuisé pour cette priorité (réserve admin)"""
+        # Instantané périmé : rafraîchi en arrière-plan, la requête n'attend pas la base
+        if pool_stats.staleness > pool_stats.max_age and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(self._refresh_pool_stats())
+        snapshot = pool_stats.snapshot
+        if snapshot is None:
+            return
+        floor = 0 if priority == 0 else self.pool_reserve
+        if snapshot["available"] <= floor:
+            self._reject("pool_exhausted", self.pool_retry_after)
+
+    async def acquire(self, priority: int = 1):
+        """Obtient une place (immédiatement ou après une courte attente), sinon lève une 503"""
+        while self._waiters and self._waiters[0][2].done():  # attentes abandonnées (timeout)
+            heapq.heappop(self._waiters)
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if self.queued >= self.max_queue:
+            self._reject("queue_full", self.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # Place attribuée au moment même du timeout ou de l'annulation : on la rend
+                self.release(0.0, observe=False)
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject("queue_timeout", self.retry_after + self.latency)
+        finally:
+            self.queued -= 1
+            self.queue_wait += 0.1 * (time.monotonic() - start - self.queue_wait)
+
+    def release(self, elapsed: float, observe: bool = True):
+        """Libère une place et la transmet aux requêtes en attente (par priorité) tant que la limite le permet"""
+        if observe:
+            self.latency += 0.1 * (elapsed - self.latency)
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.in_flight += 1  # place réservée pour la requête réveillée
+                future.set_result(None)
+
+
+admission = AdmissionController()  # /mask/call
+batch_admission = AdmissionController(  # /mask/calls
+    max_in_flight=int(os.getenv("ADMISSION_BATCH_MAX_IN_FLIGHT", "8")),
+    target_latency=float(os.getenv("ADMISSION_BATCH_TARGET_LATENCY", "5"))
+)
+
+
+def admission_required(controller: AdmissionController):
+    """Dépendance FastAPI : place réservée auprès de controller pendant tout le traitement de la requête"""
+    async def admitted(token: dict = Depends(jwt_required)):
+        await controller.acquire(priority_of(token))
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            controller.release(time.monotonic() - start)
+    return admitted
@@ -0,0 +1,83 @@
+import random  # Point de départ aléatoire dans l'index rand_key
+
+#----------------------------------- Moteur d'allocation des numéros proxy ----------------------------------------
+# Chaque numéro disponible porte une clé aléatoire (rand_key) indexée partiellement sur status = 'available'.
+# On tire un point de départ au hasard et on réclame le premier numéro libre au-delà, en une seule instruction :
+#   - FOR UPDATE SKIP LOCKED : deux requêtes concurrentes ne peuvent jamais réclamer le même numéro
+#   - parcours d'index borné par LIMIT 1 : coût quasi constant, même avec des millions de lignes
+# Si aucun numéro n'est trouvé après le point de départ, on reprend depuis le début de l'index.
+
+CLAIM_SQL = """
+    UPDATE proxy_pool
+    SET status = 'assigned', assigned_to = %(mapping)s, call_id = %(call_id)s, expires_at = %(expires_at)s,
+        pair_hash = %(pair_hash)s
+    WHERE id = (
+        SELECT id FROM proxy_pool
+        WHERE status = 'available' AND rand_key {op} %(start)s
+        ORDER BY rand_key {order}
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) AND status = 'available'
+    RETURNING proxy_number;
+"""
+_CLAIM_FORWARD = CLAIM_SQL.format(op=">=", order="ASC")
+_CLAIM_WRAP = CLAIM_SQL.format(op="<", order="DESC")
+
+
+async def claim_proxy(conn, mapping, call_id: str, expires_at, pair_hash: bytes | None = None) -> str | None:
+    """Réserve atomiquement un numéro proxy disponible ; retourne None si le pool est épuisé"""
+    params = {"mapping": mapping, "call_id": call_id, "expires_at": expires_at, "pair_hash": pair_hash, "start": random.random()}
+    for sql in (_CLAIM_FORWARD, _CLAIM_WRAP):
+        cur = await conn.execute(sql, params)
+        row = await cur.fetchone()
+        if row:
+            return row[0]
+    return None
+
+#----------------------------------- Allocation par lot (/mask/calls) ----------------------------------------
+# N numéros réservés et assignés en une seule instruction : les mappings et call_id sont passés en tableaux,
+# dépliés par unnest et associés un à un aux numéros réservés (rang rn).
+
+CLAIM_MANY_SQL = """
+    WITH claimed AS (
+        SELECT id, row_number() OVER (ORDER BY rand_key {order}) AS rn FROM (
+            SELECT id, rand_key FROM proxy_pool
+            WHERE status = 'available' AND rand_key {op} %(start)s
+            ORDER BY rand_key {order}
+            LIMIT %(count)s
+            FOR UPDATE SKIP LOCKED
+        ) free
+    ),
+    items AS (
+        SELECT * FROM unnest(%(mappings)s::bytea[], %(call_ids)s::text[], %(pair_hashes)s::bytea[])
+            WITH ORDINALITY AS i(mapping, call_id, pair_hash, rn)
+    )
+    UPDATE proxy_pool p
+    SET status = 'assigned', assigned_to = items.mapping, call_id = items.call_id, expires_at = %(expires_at)s,
+        pair_hash = items.pair_hash
+    FROM claimed JOIN items USING (rn)
+    WHERE p.id = claimed.id
+    RETURNING items.call_id, p.proxy_number;
+"""
+_CLAIM_MANY_FORWARD = CLAIM_MANY_SQL.format(op=">=", order="ASC")
+_CLAIM_MANY_WRAP = CLAIM_MANY_SQL.format(op="<", order="DESC")
+
+
+async def claim_proxies(conn, mappings: list, call_ids: list[str], expires_at, pair_hashes: list[bytes]) -> dict[str, str]:
+    """Réserve un numéro par couple (mapping, call_id) ; retourne {call_id: proxy_number} (partiel si pool épuisé)"""
+    assigned = {}
+    start = random.random()
+    for sql in (_CLAIM_MANY_FORWARD, _CLAIM_MANY_WRAP):
+        pending = [i for i, call_id in enumerate(call_ids) if call_id not in assigned]
+        if not pending:
+            break
+        cur = await conn.execute(sql, {
+            "start": start,
+            "count": len(pending),
+            "mappings": [mappings[i] for i in pending],
+            "call_ids": [call_ids[i] for i in pending],
+            "pair_hashes": [pair_hashes[i] for i in pending],
+            "expires_at": expires_at,
+        })
+        assigned.update({call_id: proxy for call_id, proxy in await cur.fetchall()})
+    return assigned
@@ -0,0 +1,40 @@
+import time
+from collections import OrderedDict
+
+#----------------------------------- Cache LRU borné avec expiration par entrée ----------------------------------------
+# Utilisé depuis la boucle asyncio uniquement (pas de verrou) : tokens vérifiés, mappings déchiffrés, etc.
+# Chaque entrée expire à une date absolue (timestamp epoch), par exemple le champ exp d'un JWT.
+
+class TTLCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()  # clé -> (valeur, expire_à)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)  # entrée récemment utilisée
+        return value
+
+    def set(self, key, value, expires_at: float):
+        if self.maxsize <= 0 or expires_at <= time.time():
+            return
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)  # éviction de l'entrée la moins récemment utilisée
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
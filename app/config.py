@@ -0,0 +1,7 @@
+from dotenv import load_dotenv
+
+#----------------------------------- Chargement unique du fichier .env ----------------------------------------
+# Importé en premier par chaque module qui lit os.getenv : le fichier n'est lu qu'une fois par processus,
+# quel que soit l'ordre des imports. Les variables déjà présentes dans l'environnement restent prioritaires.
+
+load_dotenv()
@@ -0,0 +1,66 @@
+import os
+from psycopg_pool import AsyncConnectionPool  # Pool de connexions asynchrones PostgreSQL (psycopg 3)
+import config  # charge .env (une seule fois par processus)
+
+#----------------------------------- Pool de connexions partagé ----------------------------------------
+# Une seule instance par processus, créée dans le lifespan de l'application (voir main.py)
+_pool: AsyncConnectionPool | None = None
+
+
+def _connection_budget() -> int:
+    """Connexions disponibles pour le pool d'un worker : budget total (DB_MAX_CONNECTIONS) partagé entre les
+    API_WORKERS workers lancés par run_api.py, moins la connexion LISTEN de l'index des abonnés"""
+    budget = int(os.getenv("DB_MAX_CONNECTIONS", "90"))  # max_connections de PostgreSQL (100) moins une marge
+    workers = int(os.getenv("API_WORKERS", "1"))
+    listener = 1 if os.getenv("SUBSCRIBER_CACHE_ENABLED", "1") == "1" else 0
+    per_worker = budget // workers - listener
+    if per_worker < 1:
+        raise ValueError(f"DB_MAX_CONNECTIONS={budget} insuffisant pour {workers} workers")
+    return per_worker
+
+
+def _pool_settings() -> dict:
+    """Lit la configuration du pool depuis .env (valeurs par défaut adaptées au développement)"""
+    max_size = min(int(os.getenv("DB_POOL_MAX_SIZE", "10")), _connection_budget())
+    return {
+        "min_size": min(int(os.getenv("DB_POOL_MIN_SIZE", "2")), max_size),
+        "max_size": max_size,
+        # Délai maximum d'attente d'une connexion libre avant erreur (secondes)
+        "timeout": float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        # Les connexions inactives au-delà de ce délai sont fermées (secondes)
+        "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+    }
+
+
+async def init_pool() -> AsyncConnectionPool:
+    """Ouvre le pool et attend que min_size connexions soient prêtes"""
+    global _pool
+    if _pool is not None:
+        return _pool
+    settings = _pool_settings()
+    # Vérification de santé d'une connexion avant de la prêter (désactivable si le réseau est fiable)
+    check = AsyncConnectionPool.check_connection if os.getenv("DB_POOL_HEALTH_CHECK", "1") == "1" else None
+    _pool = AsyncConnectionPool(
+        conninfo=os.getenv("DATABASE_URL"),
+        open=False,
+        check=check,
+        name="api-masquage",
+        **settings,
+    )
+    await _pool.open(wait=True, timeout=settings["timeout"])
+    return _pool
+
+
+async def close_pool():
+    """Ferme proprement toutes les connexions du pool (appelé à l'arrêt de l'application)"""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> AsyncConnectionPool:
+    """Retourne le pool initialisé ; lève une erreur si le lifespan ne l'a pas encore ouvert"""
+    if _pool is None:
+        raise RuntimeError("Pool de connexions non initialisé")
+    return _pool
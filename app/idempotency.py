@@ -0,0 +1,82 @@
+import os
+import hmac
+import hashlib
+from datetime import datetime
+from fastapi import HTTPException
+import config  # charge .env (une seule fois par processus)
+from cache import TTLCache
+from database import get_pool
+
+#----------------------------------- Idempotence des demandes de masquage ----------------------------------------
+# Un même couple (appelant, appelé) réutilise son numéro proxy tant que l'assignation est active.
+# Le chiffrement Fernet n'étant pas déterministe, le couple est identifié par un HMAC-SHA256 à clé secrète
+# (colonne proxy_pool.pair_hash, indexée) : il ne révèle pas les numéros réels.
+# Deux demandes simultanées pour un même couple sont sérialisées par un verrou consultatif (lock_pair) :
+# la seconde retrouve l'assignation créée par la première au lieu d'allouer un autre numéro.
+
+_PAIR_KEY = (os.getenv("PAIR_HASH_KEY") or os.getenv("SECRET_KEY") or "").encode()
+
+_by_pair = TTLCache(maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000")))  # pair_hash -> réponse
+_by_key = TTLCache(maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000")))   # (sub, clé) -> (pair_hash, réponse)
+
+ACTIVE_SQL = """
+    SELECT proxy_number, call_id, expires_at FROM proxy_pool
+    WHERE pair_hash = %s AND status = 'assigned' AND expires_at > %s
+    ORDER BY expires_at DESC LIMIT 1;
+"""
+
+
+def pair_hash(caller_real: str, callee_real: str) -> bytes:
+    return hmac.new(_PAIR_KEY, f"{caller_real}|{callee_real}".encode(), hashlib.sha256).digest()
+
+
+def get_by_idempotency_key(sub: str, key: str | None, pair: bytes) -> dict | None:
+    """Réponse déjà envoyée pour cette clé Idempotency-Key (propre à chaque utilisateur).
+    Une clé réutilisée pour un autre couple (appelant, appelé) est refusée en 422."""
+    stored = _by_key.get((sub, key)) if key else None
+    if stored is None:
+        return None
+    stored_pair, response = stored
+    if not hmac.compare_digest(stored_pair, pair):
+        raise HTTPException(status_code=422, detail="Idempotency-Key déjà utilisée pour une autre demande")
+    return response
+
+
+async def _fetch_active(conn, pair: bytes) -> dict | None:
+    cur = await conn.execute(ACTIVE_SQL, (pair, datetime.now()))
+    row = await cur.fetchone()
+    if not row:
+        return None
+    proxy, call_id, expires_at = row
+    response = {
+        "success": True,
+        "call_id": call_id,
+        "proxy_number": proxy,
+        "expires_at": expires_at.isoformat(),
+        "message": "Numéro réel masqué par proxy (simulation)"
+    }
+    _by_pair.set(pair, response, expires_at.timestamp())
+    return response
+
+
+async def find_active_assignment(pair: bytes) -> dict | None:
+    """Assignation encore active pour ce couple : cache mémoire, puis index pair_hash en base"""
+    response = _by_pair.get(pair)
+    if response is not None:
+        return response
+    async with get_pool().connection() as conn:
+        return await _fetch_active(conn, pair)
+
+
+async def lock_pair(conn, pair: bytes) -> dict | None:
+    """Verrou consultatif sur le couple jusqu'à la fin de la transaction de conn, puis nouvelle vérification :
+    retourne l'assignation active créée entre-temps par une demande concurrente (sinon None, allouer)"""
+    await conn.execute("SELECT pg_advisory_xact_lock(%s)", (int.from_bytes(pair[:8], "big", signed=True),))
+    return await _fetch_active(conn, pair)
+
+
+def remember(pair: bytes, response: dict, expires_at: datetime, sub: str | None = None, key: str | None = None):
+    """Mémorise la réponse jusqu'à l'expiration de l'assignation"""
+    _by_pair.set(pair, response, expires_at.timestamp())
+    if key:
+        _by_key.set((sub, key), (pair, response), expires_at.timestamp())
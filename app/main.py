@@ -1,67 +1,104 @@
-from fastapi import FastAPI, HTTPException, Body, Depends, Request #framework pour créer l'API REST, HTTPException pour erreurs
-import psycopg2 #connexion à PostgreSQL
-from dotenv import load_dotenv #charger les variables d'environnement depuis .env
+from fastapi import FastAPI, HTTPException, Body, Depends, Path, Request #framework pour créer l'API REST, HTTPException pour erreurs
+from contextlib import asynccontextmanager #cycle de vie de l'application (ouverture/fermeture du pool DB)
+import config #charger les variables d'environnement depuis .env (une seule fois)
 import os
-from faker import Faker #générer des données fictives (numéros proxy)
+import random #générer des numéros proxy fictifs
 import uuid #générer des identifiants uniques pour les appels
 #-------logs
 from datetime import datetime, timedelta #gérer l'expiration des proxies
-#-------simulation
-import threading  # Pour simulation en background
-import time  # Pour délais simulés
-import random  # Pour résultats aléatoires
 import logging  # Pour journaliser les erreurs internes sans les exposer
-#------- rate limiting
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
 
 
 
 #----------------------------------------------- Importer toutes les fonctions de securite.py ----------------------------------------------------------------------------------
 
 from securite import (
-    create_jwt_token,jwt_required,verify_password,encrypt_mapping,LoginRequest,MaskRequest,require_scope, verify_user_exists
+    create_jwt_token,jwt_required,verify_password_async,hashing_pool,encrypt_mapping,encrypt_mappings,check_encryption_keys,LoginRequest,MaskRequest,MaskBatchRequest,require_scope, verify_user_exists, find_unregistered
 )
-#----------------------- Charger les variables d'environnement depuis le fichier .env ------------------------------------------
-load_dotenv()
+from database import init_pool, close_pool, get_pool
+from allocation import claim_proxy, claim_proxies
+from subscribers import start_subscriber_index, stop_subscriber_index
+from reaper import start_reaper, stop_reaper
+from simulation import call_scheduler
+from idempotency import pair_hash, get_by_idempotency_key, find_active_assignment, lock_pair, remember
+from metrics import StageTimer, Gauge, render_metrics, profile_request, PROFILING_ENABLED
+from ratelimit import limit_by_ip, limit_by_user
+from admission import admission, batch_admission, admission_required, priority_of
+from pool_stats import pool_stats
+from routing import resolve_route
+from subscribers import subscriber_index
+#------------------------------ Cycle de vie : pool de connexions PostgreSQL partagé ---------------------------
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Exécuté dans chaque worker après son démarrage : clés, pool DB, caches et tâches sont propres au processus
+    check_encryption_keys()
+    # Un seul pool par processus au lieu d'une connexion par requête
+    await init_pool()
+    # Index des abonnés : chargement complet puis mises à jour via LISTEN/NOTIFY
+    start_subscriber_index()
+    # Recyclage périodique des numéros proxy expirés
+    start_reaper()
+    # Ordonnanceur de simulation des appels (RINGING/ANSWERED/HANGUP)
+    call_scheduler.start()
+    try:
+        yield
+    finally:
+        await call_scheduler.stop()
+        await stop_reaper()
+        await stop_subscriber_index()
+        await close_pool()
+        hashing_pool.shutdown()
+
 #------------------------------ Création de l'application FastAPI ---------------------------------------------
 
 app = FastAPI(
     title="API Masquage Appels - Tunisie Telecom PFE",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 #------------------------------------------implementer le rate limiting --------------------
 
-# Initialiser le limiter (basé sur l'IP pour simplicité ; ajustable pour JWT si besoin)
-limiter = Limiter(key_func=get_remote_address, default_limits=["10/minute"])  # 100 req/min pendant dev ; ajustez à 10/minute en prod
-
-#middleware fourni par SlowAPI sert a vérifier à chaque requête si l’utilisateur (ou IP) a dépassé le quota de requêtes autorisées.
-app.add_middleware(SlowAPIMiddleware)
-# Attacher le Limiter à l'état de l'application
-app.state.limiter = limiter
-# Gestionnaire d'erreur personnalisé (évite l'exposition de détails)
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
-@app.exception_handler(RateLimitExceeded)
-async def ratelimit_handler(request: Request, exc):
-    return JSONResponse(
-        status_code=429,
-        content={"detail": "Limite de requêtes atteinte. Veuillez réessayer plus tard"}
-    )
+# Quotas par route uniquement (aucun coût sur /health, /metrics, /route), partagés entre tous les workers
+# de la machine (voir ratelimit.py). /auth/login est limité par IP, les routes authentifiées par utilisateur (sub).
+LOGIN_LIMIT = os.getenv("RATE_LIMIT_LOGIN", "5/minute")
+POOL_STATUS_LIMIT = os.getenv("RATE_LIMIT_POOL_STATUS", "2/minute")
+MASK_CALL_LIMIT = os.getenv("RATE_LIMIT_MASK_CALL", "10/minute")
+MASK_CALLS_LIMIT = os.getenv("RATE_LIMIT_MASK_CALLS", "10/minute")
 
 
-#----------------------------------------  Connexion à la base de données PostgreSQL  -----------------------------------
+#------------------------------------------ Instrumentation (/metrics) --------------------
 
-def get_db_connection():
-    return psycopg2.connect(os.getenv('DATABASE_URL'))
+# Profilage d'une requête à la demande (en-tête X-Profile: 1) : middleware installé seulement si METRICS_PROFILING=1
+# et pyinstrument disponible, sinon aucune requête ne traverse de middleware
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_request)
 
-#-----------------------Initialisation de Faker (pour générer des numéros fictifs) ------------------------
+# Jauges lues au moment de l'export : aucun coût sur le chemin des requêtes
+def _db_pool_stats():
+    try:
+        stats = get_pool().get_stats()
+    except RuntimeError:
+        return {}
+    return {(key,): stats.get(key, 0) for key in ("pool_size", "pool_available", "requests_waiting")}
+
+Gauge("db_pool_connections", "État du pool de connexions PostgreSQL", ("state",), callback=_db_pool_stats)
+Gauge("bcrypt_pending_tasks", "Vérifications bcrypt en cours ou en attente", callback=lambda: {(): hashing_pool.pending})
+Gauge("simulated_calls_active", "Appels suivis par l'ordonnanceur de simulation", callback=lambda: {(): call_scheduler.active_calls})
+Gauge("subscriber_index_numbers", "Numéros présents dans l'index des abonnés", callback=lambda: {(): subscriber_index.count})
+_admission_controllers = {"mask_call": admission, "mask_calls": batch_admission}
+Gauge("admission_requests", "Demandes de masquage admises ou en file d'attente", ("handler", "state"),
+      callback=lambda: {(name, state): value for name, c in _admission_controllers.items()
+                        for state, value in (("in_flight", c.in_flight), ("queued", c.queued), ("limit", c.limit))})
+Gauge("admission_latency_seconds", "Latences moyennes (EWMA) vues par le contrôle d'admission", ("handler", "kind"),
+      callback=lambda: {(name, kind): value for name, c in _admission_controllers.items()
+                        for kind, value in (("handler", c.latency), ("queue", c.queue_wait))})
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
-fake = Faker()
-   
 #----------------------------- Endpoint de test de santé (Vérifie si l’API est opérationnelle et si la connexion à la base est possible --------------------------------
 
 @app.get("/health")
@@ -71,27 +108,29 @@ def health():
 #-------------------------------- authentification JWT  -----------------------------------
  
 
-@app.post("/auth/login")
-@limiter.limit("5/minute")
+@app.post("/auth/login", dependencies=[Depends(limit_by_ip("login", LOGIN_LIMIT))])
 
 async def login(request: Request, credentials: LoginRequest = Body(...)):
+    timer = StageTimer("login")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         username = credentials.username
         password = credentials.password
-        logging.debug(f"Connexion à la DB OK. Username recherché : {username}")
-
-        cur.execute("SELECT password FROM users WHERE username = %s", (username,))
-        result = cur.fetchone()
-        logging.debug(f"Résultat SQL : {result}")
-
-        cur.close()
-        conn.close()
 
-        if result and verify_password(password, result[0]):
-            token = create_jwt_token(username)
+        async with get_pool().connection() as conn:
+            logging.debug(f"Connexion à la DB OK. Username recherché : {username}")
+            # Hash et scope en une seule requête (le token est créé sans nouvel accès DB)
+            cur = await conn.execute("SELECT password, scope FROM users WHERE username = %s", (username,))
+            result = await cur.fetchone()
+        logging.debug(f"Utilisateur trouvé : {result is not None}")
+        timer.mark("db_fetch")
+
+        # Vérification bcrypt sur le pool de workers (la boucle asyncio reste libre pour les autres requêtes)
+        password_ok = bool(result) and await verify_password_async(password, result[0])
+        timer.mark("bcrypt")
+        if password_ok:
+            token = create_jwt_token(username, result[1])
+            timer.mark("jwt_encode")
+            timer.done()
             logging.debug(f"Token créé pour {username}")
             return {"access_token": token, "token_type": "bearer"}
         
@@ -106,28 +145,28 @@ async def login(request: Request, credentials: LoginRequest = Body(...)):
 
 #---------------------------- Endpoint : Statut du pool de numéros proxy --------------------------------
 
-@app.get("/pool/status")
-@limiter.limit("2/minute")
+@app.get("/pool/status", dependencies=[Depends(limit_by_user("pool_status", POOL_STATUS_LIMIT))])
 async def pool_status(request: Request, token: dict = Depends(require_scope("admin"))):
+    timer = StageTimer("pool_status")
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        # Compter les numéros disponibles
-        cur.execute("SELECT COUNT(*) FROM proxy_pool WHERE status = 'available';")
-        available = cur.fetchone()[0]
-        # Compter le total de numéros
-        cur.execute("SELECT COUNT(*) FROM proxy_pool;")
-        total = cur.fetchone()[0]
-        #connexion a bd
-        cur.close()
-        conn.close()
+        # Compteurs maintenus par triggers, lus au plus une fois toutes les POOL_STATS_MAX_AGE secondes
+        stats = await pool_stats.get()
+        timer.mark("stats_snapshot")
+        total = stats["total"]
+        available = stats["available"]
         # Calcul du pourcentage d’utilisation du pool
         usage = ((total - available) / total * 100) if total > 0 else 0
+        timer.done()
         #resultat de requete
         return {
             "total_proxies": total,
             "available_proxies": available,
+            "assigned_proxies": stats["assigned"],
+            "expired_proxies": stats["expired"],
+            "expired_proxies_capped": stats["expired_capped"],  # vrai : expired_proxies est une borne inférieure
+            "by_prefix": stats["by_prefix"],
             "usage_percent": f"{usage:.1f}%",
+            "staleness_seconds": round(pool_stats.staleness, 3),
             "message": "Pool fictif pour simulation de masquage d'appels"
         }
     #capturer les erreurs survenant pendant l’exécution du code et retournent une réponse HTTP 500 avec un message expliquant la cause de l’erreur
@@ -136,38 +175,38 @@ async def pool_status(request: Request, token: dict = Depends(require_scope("adm
         raise HTTPException(status_code=500, detail="Erreur interne du serveur")
 #---------------------------------- Endpoint principal : Masquage d’un appel  -------------------------------------
 
-@app.post("/mask/call")
+# Le rate limiting borne chaque utilisateur, le contrôle d'admission protège le pool et la base (voir admission.py)
+@app.post("/mask/call", dependencies=[Depends(limit_by_user("mask_call", MASK_CALL_LIMIT)), Depends(admission_required(admission))])
 
-async def mask_call(request: Request, body: MaskRequest = Body(...), token: str = Depends(jwt_required)):    
+async def mask_call(request: Request, body: MaskRequest = Body(...), token: dict = Depends(jwt_required)):    
     caller_real = body.caller_real
     callee_real = body.callee_real
 
+    timer = StageTimer("mask_call")
     try:
-        verify_user_exists(caller_real)
-        verify_user_exists(callee_real)
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Chercher un numéro proxy disponible de manière aléatoire
-        cur.execute(""" SELECT proxy_number FROM proxy_pool WHERE status = 'available'ORDER BY RANDOM() LIMIT 1;""")
-        result = cur.fetchone()
-
-        # Si aucun numéro disponible, en créer un nouveau fictif
-        if not result:
-            new_proxy = f"+21600{fake.random_number(digits=6):06d}"
-            cur.execute(
-                "INSERT INTO proxy_pool (proxy_number, status) VALUES (%s, 'available') RETURNING proxy_number;",
-                (new_proxy,)
-            )
-            new_result = cur.fetchone()
-            if new_result:
-                proxy = new_result[0]
-            else:
-                cur.close()
-                conn.close()
-                raise HTTPException(status_code=503, detail="Échec de génération du numéro proxy")
-        else:
-            proxy = result[0]
+        user_sub = token.get('sub', "inconnu")
+
+        # Requête rejouée avec la même clé Idempotency-Key (et le même couple) : même réponse, aucune nouvelle allocation
+        pair = pair_hash(caller_real, callee_real)
+        idempotency_key = request.headers.get("Idempotency-Key")
+        previous = get_by_idempotency_key(user_sub, idempotency_key, pair)
+        if previous is not None:
+            return previous
+
+        await verify_user_exists(caller_real)
+        await verify_user_exists(callee_real)
+        timer.mark("verify_users")
+
+        # Couple déjà masqué et encore actif : on réutilise son numéro proxy
+        existing = await find_active_assignment(pair)
+        timer.mark("idempotency_lookup")
+        if existing is not None:
+            remember(pair, existing, datetime.fromisoformat(existing["expires_at"]), user_sub, idempotency_key)
+            timer.done()
+            return existing
+
+        # Nouvelle allocation nécessaire : délestage si le pool est épuisé (après les recherches d'idempotence)
+        admission.check_pool(priority_of(token))
 
         # Création du mapping chiffré entre appelant et appelé
         mapping = {"caller_real": body.caller_real, "callee_real": body.callee_real}        
@@ -178,41 +217,142 @@ async def mask_call(request: Request, body: MaskRequest = Body(...), token: str
 
         # Date d’expiration (le proxy est valide 24h)
         expires_at = datetime.now() + timedelta(hours=24)
+        timer.mark("encrypt")
+
+        async with get_pool().connection() as conn:
+            # Demande concurrente pour le même couple (ex. retry du client) : on attend la fin de sa transaction
+            # et on réutilise le numéro qu'elle vient d'assigner
+            concurrent = await lock_pair(conn, pair)
+            if concurrent is None:
+                # Réserver atomiquement un numéro proxy disponible, choisi aléatoirement (commit à la sortie du bloc)
+                proxy = await claim_proxy(conn, encrypted_mapping, call_id, expires_at, pair)
+
+                # Si aucun numéro disponible, en créer un nouveau fictif directement assigné
+                if proxy is None:
+                    new_proxy = f"+21600{random.randrange(10**6):06d}"
+                    cur = await conn.execute(
+                        """INSERT INTO proxy_pool (proxy_number, status, assigned_to, call_id, expires_at, pair_hash)
+                           VALUES (%s, 'assigned', %s, %s, %s, %s)
+                           ON CONFLICT (proxy_number) DO NOTHING RETURNING proxy_number;""",
+                        (new_proxy, encrypted_mapping, call_id, expires_at, pair)
+                    )
+                    new_result = await cur.fetchone()
+                    if not new_result:
+                        raise HTTPException(status_code=503, detail="Échec de génération du numéro proxy")
+                    proxy = new_result[0]
+        timer.mark("allocate_commit")
+        if concurrent is not None:
+            remember(pair, concurrent, datetime.fromisoformat(concurrent["expires_at"]), user_sub, idempotency_key)
+            timer.done()
+            return concurrent
 
-        # Mettre à jour le proxy dans la base : assignation à un appel
-        cur.execute("""
-            UPDATE proxy_pool 
-            SET status = 'assigned',assigned_to = %s,call_id = %s,expires_at = %s WHERE proxy_number = %s RETURNING id;
-        """, (encrypted_mapping, call_id, expires_at, proxy))
-
-        conn.commit()
-        cur.close()
-        conn.close()
-       
-        # Simulation d'Appel en Background
-        def simulate_call(proxy, call_id):
-            events = ["RINGING", "ANSWERED", "HANGUP"]
-            for event in events:
-                time.sleep(random.uniform(1, 3))
-                status = "SUCCESS" if random.random() > 0.1 else "FAILED (busy)"
-                print(f"Simulation: {event} - {status}")
-
-        user_sub = token.get('sub') if token else "inconnu"
         logging.info(f"Appel masqué : call_id={call_id}, proxy={proxy}, utilisateur={user_sub}")
 
-        threading.Thread(target=simulate_call, args=(proxy, call_id)).start()
+        # Simulation d'Appel en Background (ordonnanceur asyncio unique, sans thread par appel)
+        if not call_scheduler.schedule(call_id, proxy):
+            logging.warning(f"Simulation ignorée (capacité atteinte) : call_id={call_id}")
+        timer.mark("schedule_simulation")
 
-        # Réponse envoyée à l’utilisateur
-        return {
+        # Réponse envoyée à l’utilisateur (mémorisée pour les demandes répétées)
+        response = {
             "success": True,
             "call_id": call_id,
             "proxy_number": proxy,
             "expires_at": expires_at.isoformat(),
             "message": "Numéro réel masqué par proxy (simulation)"
         }
+        remember(pair, response, expires_at, user_sub, idempotency_key)
+        timer.done()
+        return response
     except HTTPException as e:
         raise e
     except Exception as e:
         logging.error(f"Erreur interne dans /mask/call : {str(e)}")
         raise HTTPException(status_code=500, detail="Erreur interne du serveur")
 
+#---------------------------------- Endpoint : Masquage d'appels par lot (campagnes) -------------------------------------
+# Un aller-retour par étape et non par appel : validation des numéros en une requête, chiffrement en mémoire,
+# réservation + assignation de tous les numéros proxy en une seule instruction (une transaction).
+
+@app.post("/mask/calls", dependencies=[Depends(limit_by_user("mask_calls", MASK_CALLS_LIMIT)), Depends(admission_required(batch_admission))])
+
+async def mask_calls(request: Request, body: MaskBatchRequest = Body(...), token: dict = Depends(jwt_required)):
+    timer = StageTimer("mask_calls")
+    try:
+        # Chaque appel du lot demande un nouveau numéro : délestage immédiat si le pool est épuisé
+        batch_admission.check_pool(priority_of(token))
+
+        # Étape 1 : numéros non enregistrés, pour tout le lot à la fois
+        unregistered = await find_unregistered(
+            [n for item in body.calls for n in (item.caller_real, item.callee_real)]
+        )
+
+        results = [None] * len(body.calls)
+        accepted = []
+        for index, item in enumerate(body.calls):
+            if item.caller_real in unregistered or item.callee_real in unregistered:
+                results[index] = {"index": index, "success": False, "detail": "Le numéro demandé n’est pas enregistré sur le réseau"}
+            else:
+                accepted.append(index)
+        timer.mark("verify_users")
+
+        # Étape 2 : mappings chiffrés et identifiants d'appel
+        mappings = encrypt_mappings([{"caller_real": body.calls[i].caller_real, "callee_real": body.calls[i].callee_real} for i in accepted])
+        call_ids = [str(uuid.uuid4()) for _ in accepted]
+        pair_hashes = [pair_hash(body.calls[i].caller_real, body.calls[i].callee_real) for i in accepted]
+        expires_at = datetime.now() + timedelta(hours=24)
+        timer.mark("encrypt")
+
+        # Étape 3 : réservation et assignation de tous les numéros en une instruction
+        assigned = {}
+        if accepted:
+            async with get_pool().connection() as conn:
+                assigned = await claim_proxies(conn, mappings, call_ids, expires_at, pair_hashes)
+        timer.mark("allocate_commit")
+
+        for index, call_id in zip(accepted, call_ids):
+            proxy = assigned.get(call_id)
+            if proxy is None:
+                results[index] = {"index": index, "success": False, "detail": "Aucun numéro proxy disponible"}
+                continue
+            results[index] = {
+                "index": index,
+                "success": True,
+                "call_id": call_id,
+                "proxy_number": proxy,
+                "expires_at": expires_at.isoformat()
+            }
+            call_scheduler.schedule(call_id, proxy)
+
+        timer.mark("schedule_simulation")
+        timer.done()
+        logging.info(f"Lot masqué : {len(assigned)}/{len(body.calls)} appels, utilisateur={token.get('sub', 'inconnu')}")
+        return {
+            "assigned": len(assigned),
+            "failed": len(body.calls) - len(assigned),
+            "results": results
+        }
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logging.error(f"Erreur interne dans /mask/calls : {str(e)}")
+        raise HTTPException(status_code=500, detail="Erreur interne du serveur")
+
+#---------------------------------- Endpoint : Routage d'un appel entrant vers le numéro réel -------------------------------------
+# Utilisé par le commutateur à chaque établissement d'appel (scope "switch", ou "admin"). Le compte du commutateur
+# est créé comme les autres par scripts/insert_users.py, avec scope = "switch" (jeton obtenu via /auth/login).
+
+@app.get("/route/{proxy_number}")
+async def route_call(request: Request, proxy_number: str = Path(pattern=r'^\+216\d{8}$'), token: dict = Depends(require_scope("switch", "admin"))):
+    timer = StageTimer("route")
+    try:
+        route = await resolve_route(proxy_number)
+        timer.done()
+        if route is None:
+            raise HTTPException(status_code=404, detail="Aucun appel actif pour ce numéro proxy")
+        return route
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logging.error(f"Erreur interne dans /route : {str(e)}")
+        raise HTTPException(status_code=500, detail="Erreur interne du serveur")
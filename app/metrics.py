@@ -0,0 +1,144 @@
+import os
+import time
+import bisect
+import logging
+
+#----------------------------------- Métriques au format Prometheus ----------------------------------------
+# Implémentation minimale sans dépendance : compteurs, jauges et histogrammes à seaux fixes, rendus en texte
+# sur /metrics. L'enregistrement d'une mesure coûte une recherche binaire et deux additions.
+
+_registry = []
+
+
+def _escape(value) -> str:
+    # Échappement du format texte Prometheus (les valeurs peuvent venir de la requête, ex. request.url.path)
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.label_names = name, doc, labels
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge:
+    """Jauge : valeur fixée explicitement, ou lue au moment de l'export via une fonction (callback)"""
+    def __init__(self, name: str, doc: str, labels: tuple = (), callback=None):
+        self.name, self.doc, self.label_names, self.callback = name, doc, labels, callback
+        self._values = {}
+        _registry.append(self)
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        values = self._values
+        if self.callback is not None:
+            try:
+                values = self.callback()  # {tuple de labels: valeur}
+            except Exception:
+                values = {}
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.label_names, self.buckets = name, doc, labels, tuple(buckets)
+        self._series = {}  # labels -> [compteurs par seau..., somme, total]
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {series[-2]}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}"
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+#----------------------------------- Métriques de l'API ----------------------------------------
+
+STAGE_SECONDS = Histogram("api_stage_seconds", "Durée de chaque étape des handlers", ("handler", "stage"))
+REQUEST_SECONDS = Histogram("api_handler_seconds", "Durée totale des handlers instrumentés", ("handler",))
+RATE_LIMITED = Counter("api_rate_limited_total", "Requêtes refusées par le rate limiting", ("path",))
+ADMISSION_REJECTED = Counter("api_admission_rejected_total", "Requêtes délestées par le contrôle d'admission", ("reason",))
+PROXY_POOL = Gauge("proxy_pool_numbers", "Numéros proxy par statut (dernière valeur connue)", ("status",))
+
+
+class StageTimer:
+    """Chronomètre par tours : mark(étape) enregistre le temps écoulé depuis la marque précédente"""
+    __slots__ = ("handler", "_start", "_last")
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self._last, self.handler, stage)
+        self._last = now
+
+    def done(self):
+        REQUEST_SECONDS.observe(time.perf_counter() - self._start, self.handler)
+
+#----------------------------------- Profilage à la demande ----------------------------------------
+# Si METRICS_PROFILING=1 et pyinstrument est installé, une requête portant l'en-tête X-Profile: 1 est profilée
+# (échantillonnage compatible asyncio) et le rapport est journalisé. Sans pyinstrument, le hook est inactif.
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+PROFILING_ENABLED = os.getenv("METRICS_PROFILING", "0") == "1" and Profiler is not None
+
+
+async def profile_request(request, call_next):
+    """Middleware HTTP (installé seulement si PROFILING_ENABLED) : profile la requête si demandé"""
+    if request.headers.get("X-Profile") != "1":
+        return await call_next(request)
+    profiler = Profiler(async_mode="enabled")
+    profiler.start()
+    try:
+        return await call_next(request)
+    finally:
+        profiler.stop()
+        logging.info(f"Profil de {request.method} {request.url.path} :\n{profiler.output_text()}")
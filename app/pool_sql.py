@@ -0,0 +1,20 @@
+#----------------------------------- Requêtes SQL partagées sur proxy_pool ----------------------------------------
+# Module sans dépendance (aucun import de l'application) : utilisé par l'API (reaper.py) comme par les scripts
+# de maintenance psycopg2 (scripts/reclaim_pool.py), qui n'ont pas besoin de la pile FastAPI pour lire une requête.
+
+# Remise en 'available' d'un lot de numéros expirés : verrous SKIP LOCKED, rand_key retiré au hasard
+RELEASE_SQL = """
+    WITH expired AS (
+        SELECT id FROM proxy_pool
+        WHERE status = 'assigned' AND expires_at <= %(now)s
+        ORDER BY expires_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE proxy_pool p
+    SET status = 'available', assigned_to = NULL, call_id = NULL, expires_at = NULL, pair_hash = NULL,
+        rand_key = random()
+    FROM expired
+    WHERE p.id = expired.id
+    RETURNING p.proxy_number;
+"""
@@ -0,0 +1,73 @@
+import os
+import time
+import asyncio
+from datetime import datetime
+from database import get_pool
+from metrics import PROXY_POOL
+
+#----------------------------------- Statistiques d'occupation du pool proxy ----------------------------------------
+# Les compteurs par statut sont maintenus par triggers dans proxy_pool_stats (scripts/schema.sql) : les lire coûte
+# quelques dizaines de lignes, quelle que soit la taille du pool. Le résultat est gardé en mémoire et partagé entre
+# requêtes pendant POOL_STATS_MAX_AGE secondes ; un seul rafraîchissement à la fois (les autres attendent son résultat).
+
+STATS_SQL = "SELECT status, prefix, SUM(count) FROM proxy_pool_stats GROUP BY status, prefix;"
+# Les numéros expirés restent 'assigned' jusqu'au passage du reaper : ce compte n'est pas maintenu par trigger
+# (il dépend de l'heure) mais lu sur l'index partiel sur expires_at, en temps proportionnel au retard du reaper.
+# Il est donc plafonné à POOL_STATS_EXPIRED_CAP lignes : au-delà, la valeur est une borne inférieure (expired_capped).
+EXPIRED_SQL = """
+    SELECT COUNT(*) FROM (
+        SELECT 1 FROM proxy_pool WHERE status = 'assigned' AND expires_at <= %s LIMIT %s
+    ) AS expired;
+"""
+
+
+class PoolStats:
+    def __init__(self):
+        self.max_age = float(os.getenv("POOL_STATS_MAX_AGE", "2"))
+        self.expired_cap = int(os.getenv("POOL_STATS_EXPIRED_CAP", "10000"))
+        self.snapshot: dict | None = None
+        self.refreshed_at = 0.0  # time.monotonic() du dernier rafraîchissement
+        self._lock = asyncio.Lock()
+
+    @property
+    def staleness(self) -> float:
+        return time.monotonic() - self.refreshed_at if self.snapshot is not None else float("inf")
+
+    async def refresh(self) -> dict:
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(STATS_SQL)
+            rows = await cur.fetchall()
+            cur = await conn.execute(EXPIRED_SQL, (datetime.now(), self.expired_cap))
+            expired = (await cur.fetchone())[0]
+        by_prefix = {}
+        for status, prefix, count in rows:
+            by_prefix.setdefault(prefix, {}).setdefault(status, 0)
+            by_prefix[prefix][status] += int(count)
+        totals = {}
+        for counts in by_prefix.values():
+            for status, count in counts.items():
+                totals[status] = totals.get(status, 0) + count
+        self.snapshot = {
+            "total": sum(totals.values()),
+            "available": totals.get("available", 0),
+            "assigned": totals.get("assigned", 0),
+            "expired": expired,
+            "expired_capped": expired >= self.expired_cap,
+            "by_prefix": by_prefix,
+        }
+        self.refreshed_at = time.monotonic()
+        for status in ("available", "assigned", "expired"):
+            PROXY_POOL.set(self.snapshot[status], status)
+        return self.snapshot
+
+    async def get(self) -> dict:
+        """Dernier instantané s'il a moins de max_age secondes, sinon rafraîchi (une seule requête DB concurrente)"""
+        if self.staleness <= self.max_age:
+            return self.snapshot
+        async with self._lock:
+            if self.staleness <= self.max_age:  # rafraîchi par une autre requête pendant l'attente
+                return self.snapshot
+            return await self.refresh()
+
+
+pool_stats = PoolStats()
@@ -0,0 +1,117 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+import tempfile
+from fastapi import HTTPException, Request, Depends
+import config  # charge .env (une seule fois par processus)
+from securite import jwt_required
+from metrics import RATE_LIMITED
+
+try:
+    import fcntl  # Verrous par plage d'octets entre processus (Linux/macOS)
+except ImportError:
+    fcntl = None
+
+#----------------------------------- Rate limiting partagé entre workers ----------------------------------------
+# Seaux à jetons (token buckets) stockés dans un fichier mappé en mémoire (/dev/shm) commun à tous les workers
+# uvicorn de la machine : la limite est la même avec 1 ou N workers. Table associative à 4 voies :
+#   clé -> empreinte 64 bits -> groupe de 4 emplacements (empreinte, jetons, dernier remplissage)
+# Une vérification = un verrou fcntl sur le groupe, une lecture et une écriture de 24 octets : O(1).
+# Sans fcntl (Windows), les seaux restent dans la mémoire du processus.
+
+_SLOT = struct.Struct("<Qdd")  # empreinte, jetons restants, horodatage du dernier remplissage
+_WAYS = 4
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_limit(limit: str) -> tuple[int, float]:
+    """"5/minute" -> (5 requêtes, 60 secondes)"""
+    count, period = limit.split("/")
+    return int(count), float(_PERIODS[period.strip().rstrip("s")])
+
+
+class SharedTokenBuckets:
+    def __init__(self, path: str | None = None, groups: int | None = None):
+        self.groups = groups or int(os.getenv("RATE_LIMIT_GROUPS", "16384"))
+        size = self.groups * _WAYS * _SLOT.size
+        if fcntl is None:
+            self._fd, self._map = None, bytearray(size)
+            return
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        path = path or os.getenv("RATE_LIMIT_SHM_PATH", os.path.join(shm_dir, "api-masquage-ratelimit"))
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def acquire(self, key: str, capacity: int, period: float) -> float:
+        """Consomme un jeton ; retourne 0 si accepté, sinon le délai (s) avant le prochain jeton"""
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        group = digest % self.groups
+        base = group * _WAYS * _SLOT.size
+        rate = capacity / period
+        now = time.time()
+        if self._fd is not None:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _WAYS * _SLOT.size, base, os.SEEK_SET)
+        try:
+            # Emplacement de la clé, sinon le moins récemment utilisé du groupe (un seau neuf est plein)
+            victim, victim_time = base, float("inf")
+            for offset in range(base, base + _WAYS * _SLOT.size, _SLOT.size):
+                stored, tokens, last = _SLOT.unpack_from(self._map, offset)
+                if stored == digest:
+                    tokens = min(capacity, tokens + (now - last) * rate)
+                    break
+                if last < victim_time:
+                    victim, victim_time = offset, last
+            else:
+                offset, tokens = victim, float(capacity)
+            if tokens >= 1:
+                _SLOT.pack_into(self._map, offset, digest, tokens - 1, now)
+                return 0.0
+            _SLOT.pack_into(self._map, offset, digest, tokens, now)
+            return (1 - tokens) / rate
+        finally:
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _WAYS * _SLOT.size, base, os.SEEK_SET)
+
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+_buckets: SharedTokenBuckets | None = None
+
+
+def _get_buckets() -> SharedTokenBuckets:
+    # Ouvert au premier usage, dans chaque worker (pas dans le superviseur)
+    global _buckets
+    if _buckets is None:
+        _buckets = SharedTokenBuckets()
+    return _buckets
+
+
+def _check(request: Request, name: str, identity: str, limit: str):
+    if not RATE_LIMIT_ENABLED:
+        return
+    capacity, period = parse_limit(limit)
+    retry_after = _get_buckets().acquire(f"{name}:{identity}", capacity, period)
+    if retry_after > 0:
+        RATE_LIMITED.inc(request.url.path)
+        raise HTTPException(
+            status_code=429,
+            detail="Limite de requêtes atteinte. Veuillez réessayer plus tard",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+
+
+def limit_by_ip(name: str, limit: str):
+    """Dépendance FastAPI : quota par adresse IP (routes non authentifiées, ex. /auth/login)"""
+    async def checker(request: Request):
+        _check(request, name, f"ip:{request.client.host if request.client else 'inconnu'}", limit)
+    return checker
+
+
+def limit_by_user(name: str, limit: str):
+    """Dépendance FastAPI : quota par utilisateur (claim sub du JWT, décodé une seule fois par requête)"""
+    async def checker(request: Request, token: dict = Depends(jwt_required)):
+        _check(request, name, f"sub:{token.get('sub')}", limit)
+    return checker
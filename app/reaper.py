@@ -0,0 +1,65 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from database import get_pool
+from routing import forget_routes
+from pool_sql import RELEASE_SQL  # requête partagée avec scripts/reclaim_pool.py
+
+#----------------------------------- Recyclage des numéros proxy expirés ----------------------------------------
+# Remet en 'available' les numéros dont l'assignation a expiré, par lots bornés :
+#   - index partiel sur expires_at (status = 'assigned') : chaque lot est un parcours d'index court
+#   - FOR UPDATE SKIP LOCKED + une transaction par lot : aucun verrou long, les allocations concurrentes continuent
+#   - rand_key est retiré au hasard pour que les numéros recyclés se répartissent dans l'index d'allocation
+
+
+async def release_expired(batch_size: int | None = None, max_batches: int | None = None) -> list[str]:
+    """Recycle les numéros expirés lot par lot ; retourne la liste des numéros remis dans le pool"""
+    batch_size = batch_size or int(os.getenv("REAPER_BATCH_SIZE", "500"))
+    max_batches = max_batches or int(os.getenv("REAPER_MAX_BATCHES", "100"))
+    released = []
+    for _ in range(max_batches):
+        # Une connexion (donc une transaction courte) par lot
+        async with get_pool().connection() as conn:
+            cur = await conn.execute(RELEASE_SQL, {"now": datetime.now(), "batch_size": batch_size})
+            batch = [row[0] for row in await cur.fetchall()]
+        released.extend(batch)
+        if len(batch) < batch_size:
+            break
+    return released
+
+
+async def _reap_forever():
+    interval = float(os.getenv("REAPER_INTERVAL", "60"))
+    while True:
+        try:
+            released = await release_expired()
+            forget_routes(released)
+            if released:
+                logging.info(f"Recyclage : {len(released)} numéros proxy remis dans le pool")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Erreur pendant le recyclage des numéros proxy : {str(e)}")
+        await asyncio.sleep(interval)
+
+
+_reaper_task: asyncio.Task | None = None
+
+
+def start_reaper():
+    """Démarre le recyclage périodique (appelé dans le lifespan de l'application)"""
+    global _reaper_task
+    if os.getenv("REAPER_ENABLED", "1") == "1" and _reaper_task is None:
+        _reaper_task = asyncio.create_task(_reap_forever())
+
+
+async def stop_reaper():
+    global _reaper_task
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+        try:
+            await _reaper_task
+        except asyncio.CancelledError:
+            pass
+        _reaper_task = None
@@ -0,0 +1,46 @@
+import os
+from datetime import datetime
+from cache import TTLCache
+from database import get_pool
+from securite import decrypt_mapping
+
+#----------------------------------- Résolution proxy -> numéro réel (routage des appels entrants) ----------------------------------------
+# Le commutateur résout le numéro proxy composé à chaque établissement d'appel. Le mapping déchiffré est gardé
+# en mémoire jusqu'à expires_at : les résolutions répétées n'interrogent pas la base et ne déchiffrent plus rien.
+
+_routes = TTLCache(maxsize=int(os.getenv("ROUTE_CACHE_SIZE", "100000")))
+
+ROUTE_SQL = """
+    SELECT assigned_to, call_id, expires_at FROM proxy_pool
+    WHERE proxy_number = %s AND status = 'assigned' AND expires_at > %s;
+"""
+
+
+async def resolve_route(proxy_number: str) -> dict | None:
+    """Assignation active du numéro proxy (appelant/appelé réels), ou None s'il n'est pas assigné"""
+    route = _routes.get(proxy_number)
+    if route is not None:
+        return route
+    # Recherche par l'index unique sur proxy_number
+    async with get_pool().connection() as conn:
+        cur = await conn.execute(ROUTE_SQL, (proxy_number, datetime.now()))
+        row = await cur.fetchone()
+    if not row:
+        return None
+    assigned_to, call_id, expires_at = row
+    mapping = decrypt_mapping(assigned_to)
+    route = {
+        "proxy_number": proxy_number,
+        "call_id": call_id,
+        "caller_real": mapping["caller_real"],
+        "callee_real": mapping["callee_real"],
+        "expires_at": expires_at.isoformat(),
+    }
+    _routes.set(proxy_number, route, expires_at.timestamp())
+    return route
+
+
+def forget_routes(proxy_numbers):
+    """Retire du cache les numéros remis dans le pool (appelé par le reaper)"""
+    for proxy_number in proxy_numbers:
+        _routes.pop(proxy_number)
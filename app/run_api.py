@@ -1,22 +1,47 @@
-from main import app  # ou from app.main import app si ton main.py est dans un dossier "app"
-import uvicorn
 import os
-from dotenv import load_dotenv
+import argparse
+import uvicorn
+import config  # Charger les variables d'environnement depuis .env
 
-# Charger les variables d'environnement depuis .env
-load_dotenv()
+# Lancement de l'API :
+#   python run_api.py                 # production : un worker par cœur, dans la limite du budget DB ci-dessous
+#                                     # (WEB_CONCURRENCY pour forcer le nombre)
+#   python run_api.py --workers 1     # un seul processus (développement)
+#
+# L'application est passée sous forme "main:app" : le superviseur n'importe pas main.py, chaque worker l'importe
+# et ouvre son propre pool DB, ses caches et ses tâches de fond dans le lifespan (après son démarrage).
+# Connexions PostgreSQL : chaque worker ouvre son pool (DB_POOL_MAX_SIZE, 10 par défaut) plus une connexion LISTEN
+# (index des abonnés). Le total est borné par DB_MAX_CONNECTIONS (90 par défaut, sous le max_connections=100 de
+# PostgreSQL) : le pool de chaque worker est réduit à DB_MAX_CONNECTIONS // workers - 1 si nécessaire, et le nombre
+# de workers par défaut est plafonné à DB_MAX_CONNECTIONS // 4 (au moins 3 connexions de pool par worker).
+#   ex. 16 cœurs : 16 workers x (4 + 1) = 80 connexions au plus.
+# Redémarrage progressif : envoyer SIGHUP au superviseur, les workers sont remplacés un par un ; chaque worker
+# arrêté finit ses requêtes en cours (au plus GRACEFUL_TIMEOUT secondes) avant de fermer son pool.
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lancement de l'API de masquage d'appels")
+    default_workers = min(os.cpu_count() or 1, int(os.getenv("DB_MAX_CONNECTIONS", "90")) // 4)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(default_workers))))
+    parser.add_argument("--host", default=os.getenv("API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8000")))
+    args = parser.parse_args()
+
+    # Transmis aux workers (hérité de l'environnement) : taille de leur pool DB, voir database.py
+    os.environ["API_WORKERS"] = str(args.workers)
+
     # Récupérer les chemins depuis .env
     certfile = os.getenv("SSL_CERTFILE")
     keyfile = os.getenv("SSL_KEYFILE")
 
     # Lancer Uvicorn avec HTTPS
     uvicorn.run(
-        app,
-        host="127.0.0.1",
-        port=8000,
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
         ssl_certfile=certfile,
         ssl_keyfile=keyfile,
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
         log_level="info"
     )
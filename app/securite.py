@@ -3,56 +3,76 @@ import os # Pour accéder aux variables d'environnement
 import bcrypt # Pour le hachage des mots de passe (contre les attaques par dictionnaire)
 import jwt # PyJWT pour la gestion des tokens JWT (authentification sécurisée)
 from datetime import datetime, timedelta
-from fastapi import HTTPException, Request
-from cryptography.fernet import Fernet  # Chiffrement symétrique Fernet pour protéger les mappings sensibles
+from fastapi import HTTPException, Request, Depends
+import hashlib  # Empreinte SHA-256 des tokens (clé du cache de tokens vérifiés)
+from cryptography.fernet import Fernet, MultiFernet  # Chiffrement symétrique Fernet (anciens mappings)
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # Chiffrement authentifié des mappings compacts
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidTag
+import base64
+import struct  # Numéros empaquetés en entiers binaires
+import functools
 import json # Pour convertir les dictionnaires en JSON avant chiffrement
-from dotenv import load_dotenv # Charger les variables d'environnement depuis .env (sécurisé contre l'exposition de clés
+import config  # Charger les variables d'environnement depuis .env, une seule fois par processus (sécurisé contre l'exposition de clés)
 import re  # Pour les expressions régulières dans la validation (ex. : formats stricts pour éviter les caractères dangereux)
-from pydantic import BaseModel, field_validator  # Pour définir et valider les modèles JSON (contre OWASP : prévention des injections)
+from pydantic import BaseModel, Field, field_validator  # Pour définir et valider les modèles JSON (contre OWASP : prévention des injections)
 import logging  # Pour journaliser les erreurs internes de manière sécurisée
-import psycopg2 #connexion à PostgreSQL
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor  # Exécution de bcrypt hors de la boucle asyncio
+from database import get_pool  # Pool de connexions PostgreSQL partagé
+from subscribers import subscriber_index  # Index en mémoire des numéros enregistrés
+from cache import TTLCache  # Cache LRU borné avec expiration par entrée
 
 
 
-# Charger les variables d'environnement depuis le fichier .env (évite de hardcoder les secrets)
-load_dotenv()
-#connexion avec bd
-def get_db_connection():
-    return psycopg2.connect(os.getenv('DATABASE_URL'))
 #---------------------------------- JWT -------------------------------------
 # Classe pour les paramètres de sécurité (ex. : clé JWT)
 class Settings(BaseModel):
     authjwt_secret_key: str = os.getenv("JWT_SECRET")
+# Clé de signature lue une seule fois au chargement du module
+JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
 #fonction de creation de token JWT
-def create_jwt_token(username: str, hours_valid: int = 1) -> str:
-         # Récupérer le scope depuis la DB (ajoutez une fonction helper si besoin)
-         conn = psycopg2.connect(os.getenv('DATABASE_URL'))  # Utilisez get_db_connection si importé
-         cur = conn.cursor()
-         cur.execute("SELECT scope FROM users WHERE username = %s", (username,)) #requête SQL pour récupérer le champ scope de la table users correspondant à l’utilisateur dont le username est passé à la fonction
-         result = cur.fetchone()
-         conn.close()
-         scope = result[0] if result else "user"  # Défaut si non trouvé
+# le scope est lu par l'appelant dans la même requête que le hash du mot de passe (pas de second aller-retour DB)
+def create_jwt_token(username: str, scope: str | None = None, hours_valid: int = 1) -> str:
+         scope = scope or "user"  # Défaut si non renseigné
          
          payload = {
              "sub": username,
              "scope": scope,
              "exp": datetime.utcnow() + timedelta(hours=hours_valid)
          }
-         token = jwt.encode(payload, os.getenv('JWT_SECRET_KEY'), algorithm="HS256")
+         token = jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")
          return token 
+# Cache des tokens déjà vérifiés : clé = SHA-256 du token, entrée expirée au champ exp du token.
+# Un client réutilise le même token pour des milliers d'appels : la signature n'est vérifiée qu'une fois.
+_verified_tokens = TTLCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")))
+
+def decode_token(token: str) -> dict:
+    """Retourne les claims d'un token (depuis le cache si déjà vérifié) ; lève une erreur jwt sinon"""
+    digest = hashlib.sha256(token.encode()).digest()
+    payload = _verified_tokens.get(digest)
+    if payload is None:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
+        if "exp" in payload:  # Sans date d'expiration, pas de mise en cache
+            _verified_tokens.set(digest, payload, payload["exp"])
+    return payload
+
 # fonction Vérifie la validité du JWT envoyé dans l'en-tête Authorization.Si le token est invalide ou absent, lève HTTPException 401
-async def jwt_required(request: Request):
+# Retourne les claims ; FastAPI met la dépendance en cache par requête, le token n'est donc décodé qu'une fois
+async def jwt_required(request: Request) -> dict:
     auth_header = request.headers.get('Authorization')
 
     if auth_header and auth_header.startswith("Bearer "):
-        token = auth_header.split(" ")[1]
+        token = auth_header[len("Bearer "):]
         try:
-            jwt.decode(token, os.getenv('JWT_SECRET_KEY'), algorithms=["HS256"])
-            return  
+            payload = decode_token(token)
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401, detail="Token expiré")
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail="Token invalide")
+        request.state.claims = payload  # Claims accessibles aux handlers et middlewares
+        return payload
 
     # Si aucun header Authorization n'est présent
     raise HTTPException(status_code=401, detail="Token requis")
@@ -78,23 +98,34 @@ class MaskRequest(BaseModel):
       if 'caller_real' in info.data and v == info.data['caller_real']:
           raise ValueError('Numéros identiques interdits')
       return v
+# -------Lot de demandes de masquage (campagnes) : chaque élément est validé comme MaskRequest
+class MaskBatchRequest(BaseModel):
+    calls: list[MaskRequest] = Field(min_length=1, max_length=int(os.getenv("MASK_BATCH_MAX", "10000")))
 #------------------ verification des numeros dans la bd 
-def verify_user_exists(real_number: str):
-
-    conn = get_db_connection()
-    cur = conn.cursor()
+async def verify_user_exists(real_number: str):
 
-    cur.execute("SELECT 1 FROM users WHERE real_number = %s;", (real_number,))
-    exists = cur.fetchone()
-
-    cur.close()
-    conn.close()
+    # Index en mémoire synchronisé : aucune requête DB ; sinon (démarrage, coupure) on interroge la base
+    if subscriber_index.is_fresh():
+        exists = real_number in subscriber_index
+    else:
+        async with get_pool().connection() as conn:
+            cur = await conn.execute("SELECT 1 FROM users WHERE real_number = %s;", (real_number,))
+            exists = await cur.fetchone()
 
     if not exists:
         raise HTTPException(
             status_code=404,
             detail=f"Le numéro demandé n’est pas enregistré sur le réseau"
         )    
+# Version par lot : un seul accès DB (ou aucun si l'index est à jour) pour toute une liste de numéros
+async def find_unregistered(real_numbers) -> set:
+    numbers = set(real_numbers)
+    if subscriber_index.is_fresh():
+        return {n for n in numbers if n not in subscriber_index}
+    async with get_pool().connection() as conn:
+        cur = await conn.execute("SELECT DISTINCT real_number FROM users WHERE real_number = ANY(%s);", (list(numbers),))
+        registered = {row[0] for row in await cur.fetchall()}
+    return numbers - registered
 # ----------Classe pour définir le format du body d'authentification (avec validation pour renforcer la sécurité)
 class LoginRequest(BaseModel):  
     username: str
@@ -122,41 +153,153 @@ def hash_password(password: str) -> str:
 # fonction de Vérifie un mot de passe avec le hash stocké
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed.encode())
+#---------------------- pool de workers bcrypt -------------------
+# bcrypt coûte des dizaines de ms de CPU : on l'exécute hors de la boucle asyncio, sur un pool borné.
+# Au-delà de workers + file d'attente, la requête est refusée immédiatement (503) au lieu de s'accumuler.
+class HashingPool:
+    def __init__(self):
+        self.workers = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 2)))
+        self.max_queue = int(os.getenv("BCRYPT_MAX_QUEUE", str(self.workers * 4)))
+        self.kind = os.getenv("BCRYPT_EXECUTOR", "thread")  # "thread" (bcrypt libère le GIL) ou "process"
+        self._executor = None
+        self.pending = 0  # tâches en cours + en attente
+
+    def _get_executor(self):
+        # Création paresseuse : chaque worker uvicorn crée son propre pool après le fork
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.pending >= self.workers + self.max_queue:
+            raise HTTPException(status_code=503, detail="Service d'authentification saturé, réessayez", headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+hashing_pool = HashingPool()
+
+async def hash_password_async(password: str) -> str:
+    return await hashing_pool.run(hash_password, password)
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    return await hashing_pool.run(verify_password, password, hashed)
 #----------------------------- chiffrement mapping -------------------------------------
-# Gestion de la clé secrète pour le chiffrement (chargée depuis .env pour éviter l'exposition)
-SECRET_KEY = os.getenv("SECRET_KEY")  # Clé de chiffrement (doit être une clé Fernet valide, générée via Fernet.generate_key())
-try:
-    CIPHER_KEY = (SECRET_KEY)
-    cipher_suite = Fernet(CIPHER_KEY)  # Création du chiffreur Fernet pour protéger les mappings (caller <-> callee) contre l'exposition de données sensibles (OWASP)
-except:
-    raise ValueError("Clé SECRETS_KEY invalide")
-def encrypt_mapping(mapping_dict: dict) -> str:
-    """Chiffre un dictionnaire mapping caller <-> callee"""
-    json_data = json.dumps(mapping_dict)
-    return cipher_suite.encrypt(json_data.encode()).decode()
-def decrypt_mapping(encrypted_str: str) -> dict:
-    """Déchiffre un mapping chiffré"""
-    json_data = cipher_suite.decrypt(encrypted_str.encode()).decode()
-    return json.loads(json_data)
-#------------------------------------ controle d'accees -------------------------------
-def require_scope(required_scope: str):
-    async def scope_checker(request: Request):
-        # Vérifier la présence du token
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or " " not in auth_header:
-            raise HTTPException(status_code=401, detail="Token manquant ou invalide")
+# Format compact v1 (colonne bytea, 38 octets au lieu de ~180 caractères base64 en Fernet/JSON) :
+#   version (1 octet) | id de clé (1 octet) | nonce (12 octets) | AES-256-GCM(2 x uint32 big-endian) + tag (24 octets)
+# Les numéros +216XXXXXXXX sont stockés par leurs 8 chiffres (entier < 2^32). L'en-tête est authentifié (AAD).
+# Clés AES :
+#   - MAPPING_KEYS = "id:clé_base64,..." (id de 0 à 255, la première est la clé active) : rotation explicite, les
+#     anciennes clés restent dans la liste pour relire les lignes existantes ;
+#   - sans MAPPING_KEYS, id 0 = clé dérivée (HKDF) de SECRET_KEY. Les clés dérivées de OLD_SECRET_KEYS restent
+#     utilisables en lecture sous l'id 0 : une rotation de SECRET_KEY ne rend pas illisibles les mappings existants.
+MAPPING_FORMAT_V1 = 1
+_NONCE_SIZE = 12
+
+# Les chiffreurs sont construits au premier usage (ou par check_encryption_keys au démarrage d'un worker),
+# pas à l'import : importer le module reste rapide et ne dépend pas de la présence des secrets.
+@functools.cache
+def _mapping_ciphers() -> tuple:
+    # Gestion de la clé secrète pour le chiffrement (chargée depuis .env pour éviter l'exposition)
+    secret_key = os.getenv("SECRET_KEY")  # Clé de chiffrement (doit être une clé Fernet valide, générée via Fernet.generate_key())
+    try:
+        # Anciennes clés Fernet (OLD_SECRET_KEYS, séparées par des virgules) : déchiffrement des lignes existantes après rotation
+        cipher_suite = MultiFernet([Fernet(k) for k in [secret_key] + [k for k in os.getenv("OLD_SECRET_KEYS", "").split(",") if k]])
+    except Exception:
+        raise ValueError("Clé SECRETS_KEY invalide")
+    # id de clé -> clés candidates (la première sert au chiffrement, les suivantes seulement en lecture)
+    keys = {}
+    try:
+        for item in [k for k in os.getenv("MAPPING_KEYS", "").split(",") if k]:
+            key_id, key = item.split(":", 1)
+            key_id = int(key_id)
+            if not 0 <= key_id <= 255 or key_id in keys:
+                raise ValueError(f"id {key_id} hors de 0..255 ou en double")
+            keys[key_id] = [AESGCM(base64.urlsafe_b64decode(key))]
+    except Exception as e:
+        raise ValueError(f"MAPPING_KEYS invalide : {e}")
+    active_key_id = next(iter(keys), 0)
+    for secret in [secret_key] + [k for k in os.getenv("OLD_SECRET_KEYS", "").split(",") if k]:
+        derived = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"mapping-v1").derive(secret.encode())
+        keys.setdefault(0, []).append(AESGCM(derived))
+    return cipher_suite, active_key_id, keys
+
+def check_encryption_keys():
+    """Valide les clés de chiffrement (appelé au démarrage de l'application : erreur immédiate si invalides)"""
+    _mapping_ciphers()
+
+def get_cipher_suite() -> MultiFernet:
+    return _mapping_ciphers()[0]
 
-        token_str = auth_header.split(" ")[1]
+def _pack_number(number: str) -> int:
+    if not re.match(r'^\+216\d{8}$', number):
+        raise ValueError('Format du numéro non reconnu')
+    return int(number[4:])
 
+def encrypt_mappings(mappings: list[dict]) -> list[bytes]:
+    """Chiffre une liste de mappings caller <-> callee (un seul tirage aléatoire pour tous les nonces)"""
+    _, active_key_id, keys = _mapping_ciphers()
+    header = bytes((MAPPING_FORMAT_V1, active_key_id))
+    aead = keys[active_key_id][0]
+    nonces = os.urandom(_NONCE_SIZE * len(mappings))
+    encrypted = []
+    for i, mapping in enumerate(mappings):
+        nonce = nonces[i * _NONCE_SIZE:(i + 1) * _NONCE_SIZE]
+        plain = struct.pack(">II", _pack_number(mapping["caller_real"]), _pack_number(mapping["callee_real"]))
+        encrypted.append(header + nonce + aead.encrypt(nonce, plain, header))
+    return encrypted
+
+def _open_sealed(keys: dict, key_id: int, nonce: bytes, sealed: bytes, header: bytes) -> bytes:
+    candidates = keys.get(key_id)
+    if not candidates:
+        raise ValueError(f"Clé de chiffrement inconnue (id {key_id})")
+    # Clé courante d'abord : les autres candidates ne servent qu'aux lignes écrites avant une rotation
+    for aead in candidates[:-1]:
         try:
-            payload = jwt.decode(token_str, os.getenv("JWT_SECRET_KEY"), algorithms=["HS256"])
-        except jwt.ExpiredSignatureError:
-            raise HTTPException(status_code=401, detail="Token expiré")
-        except jwt.InvalidTokenError:
-            raise HTTPException(status_code=401, detail="Token invalide")
+            return aead.decrypt(nonce, sealed, header)
+        except InvalidTag:
+            continue
+    return candidates[-1].decrypt(nonce, sealed, header)
+
+def decrypt_mappings(blobs: list) -> list[dict]:
+    """Déchiffre une liste de mappings (format compact v1 ou ancien jeton Fernet)"""
+    cipher_suite, _, keys = _mapping_ciphers()
+    mappings = []
+    for blob in blobs:
+        if isinstance(blob, str):
+            blob = blob.encode()
+        blob = bytes(blob)
+        if blob[0] == MAPPING_FORMAT_V1:
+            header, nonce, sealed = blob[:2], blob[2:2 + _NONCE_SIZE], blob[2 + _NONCE_SIZE:]
+            caller, callee = struct.unpack(">II", _open_sealed(keys, blob[1], nonce, sealed, header))
+            mappings.append({"caller_real": f"+216{caller:08d}", "callee_real": f"+216{callee:08d}"})
+        else:
+            # Lignes antérieures au format compact : jeton Fernet contenant du JSON
+            mappings.append(json.loads(cipher_suite.decrypt(blob)))
+    return mappings
 
-        # Vérifier le scope
-        if payload.get("scope") != required_scope:
+def encrypt_mapping(mapping_dict: dict) -> bytes:
+    """Chiffre un dictionnaire mapping caller <-> callee"""
+    return encrypt_mappings([mapping_dict])[0]
+def decrypt_mapping(encrypted) -> dict:
+    """Déchiffre un mapping chiffré"""
+    return decrypt_mappings([encrypted])[0]
+#------------------------------------ controle d'accees -------------------------------
+def require_scope(*allowed_scopes: str):
+    # Réutilise les claims décodés par jwt_required (même requête => aucun second décodage)
+    async def scope_checker(payload: dict = Depends(jwt_required)):
+        # Vérifier le scope (un des scopes autorisés)
+        if payload.get("scope") not in allowed_scopes:
             raise HTTPException(status_code=403, detail="Accès interdit!!!")
 
         return payload
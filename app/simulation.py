@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+
+#----------------------------------- Simulation du cycle de vie des appels ----------------------------------------
+# Une seule tâche asyncio gère tous les appels simulés : un tas (heap) ordonné par échéance contient le prochain
+# événement de chaque appel (RINGING -> ANSWERED -> HANGUP). Aucun thread par appel, coût mémoire de quelques
+# dizaines d'octets par appel suivi, et annulation propre à l'arrêt de l'application.
+
+EVENTS = ["RINGING", "ANSWERED", "HANGUP"]
+
+_event_logger = logging.getLogger("simulation")
+
+
+def log_sink(event: dict):
+    """Sink par défaut : une ligne JSON par événement sur le logger 'simulation'"""
+    _event_logger.info(json.dumps(event))
+
+
+class CallScheduler:
+    def __init__(self, sink=log_sink, max_calls: int | None = None):
+        self.sink = sink
+        self.max_calls = max_calls or int(os.getenv("SIMULATION_MAX_CALLS", "10000"))
+        self._heap = []  # (échéance monotonic, séquence, call_id, proxy, index de l'événement)
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def active_calls(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, call_id: str, proxy: str) -> bool:
+        """Ajoute un appel à simuler ; retourne False si la capacité de suivi est atteinte"""
+        if len(self._heap) >= self.max_calls:
+            return False
+        self._push(call_id, proxy, 0)
+        return True
+
+    def _push(self, call_id: str, proxy: str, step: int):
+        self._seq += 1
+        heapq.heappush(self._heap, (time.monotonic() + random.uniform(1, 3), self._seq, call_id, proxy, step))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                # Réveil à l'échéance la plus proche, ou plus tôt si un appel plus urgent est ajouté
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, call_id, proxy, step = heapq.heappop(self._heap)
+            status = "SUCCESS" if random.random() > 0.1 else "FAILED (busy)"
+            try:
+                self.sink({"call_id": call_id, "proxy": proxy, "event": EVENTS[step], "status": status})
+            except Exception as e:
+                logging.error(f"Erreur du sink de simulation : {str(e)}")
+            if step + 1 < len(EVENTS):
+                self._push(call_id, proxy, step + 1)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Annule la tâche et oublie les appels en cours (appelé à l'arrêt de l'application)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._heap.clear()
+
+
+call_scheduler = CallScheduler()
@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import psycopg  # Connexion dédiée à l'écoute LISTEN/NOTIFY (hors pool)
+import config  # charge .env (une seule fois par processus)
+
+#----------------------------------- Index en mémoire des abonnés enregistrés ----------------------------------------
+# Les numéros ont un format fixe (+216 suivi de 8 chiffres) : un bitmap de 10^8 bits (12,5 Mo) suffit
+# pour représenter n'importe quel sous-ensemble d'abonnés, avec une recherche en O(1) sans aller-retour DB.
+
+NUMBER_PATTERN = re.compile(r'^\+216(\d{8})$')  # Même règle que MaskRequest.validate_phone
+NOTIFY_CHANNEL = "users_changed"  # Canal alimenté par le trigger users_notify_change (scripts/schema.sql)
+
+
+class SubscriberIndex:
+    def __init__(self):
+        self._bits = None  # bitmap de 12,5 Mo alloué au premier ajout (pas à l'import)
+        self.count = 0
+        self.refreshed_at = 0.0  # time.monotonic() de la dernière synchronisation confirmée
+        self.ready = False
+        self.max_staleness = float(os.getenv("SUBSCRIBER_CACHE_MAX_STALENESS", "60"))
+
+    @staticmethod
+    def _slot(real_number: str) -> int | None:
+        match = NUMBER_PATTERN.match(real_number or "")
+        return int(match.group(1)) if match else None
+
+    def __contains__(self, real_number: str) -> bool:
+        slot = self._slot(real_number)
+        return slot is not None and self._bits is not None and bool(self._bits[slot >> 3] & (1 << (slot & 7)))
+
+    def add(self, real_number: str):
+        slot = self._slot(real_number)
+        if slot is None:
+            return
+        if self._bits is None:
+            self._bits = bytearray(10**8 // 8)
+        if not self._bits[slot >> 3] & (1 << (slot & 7)):
+            self._bits[slot >> 3] |= 1 << (slot & 7)
+            self.count += 1
+
+    def discard(self, real_number: str):
+        slot = self._slot(real_number)
+        if slot is not None and self._bits is not None and self._bits[slot >> 3] & (1 << (slot & 7)):
+            self._bits[slot >> 3] &= ~(1 << (slot & 7)) & 0xFF
+            self.count -= 1
+
+    def replace(self, numbers):
+        """Reconstruit l'index à partir d'une liste complète puis bascule d'un coup (pas d'état intermédiaire visible)"""
+        fresh = SubscriberIndex()
+        for number in numbers:
+            fresh.add(number)
+        self._bits, self.count = fresh._bits, fresh.count
+        self.mark_synced()
+
+    def mark_synced(self):
+        self.refreshed_at = time.monotonic()
+        self.ready = True
+
+    def is_fresh(self) -> bool:
+        """Vrai si l'index peut répondre seul : chargé et synchronisé depuis moins que la staleness maximale"""
+        return self.ready and time.monotonic() - self.refreshed_at <= self.max_staleness
+
+
+subscriber_index = SubscriberIndex()
+
+#----------------------------------- Synchronisation avec la table users ----------------------------------------
+# Chargement complet au démarrage, puis mises à jour incrémentales reçues via NOTIFY.
+# Une recharge complète périodique borne la staleness même si une notification est perdue.
+
+async def _full_reload(conn):
+    cur = conn.cursor()
+    numbers = [row[0] async for row in cur.stream("SELECT real_number FROM users")]
+    subscriber_index.replace(numbers)
+    logging.info(f"Index abonnés chargé : {subscriber_index.count} numéros")
+
+
+def _apply_change(payload: str) -> str | None:
+    """Ajoute le nouveau numéro ; retourne l'ancien s'il faut vérifier qu'il n'existe plus avant de le retirer"""
+    change = json.loads(payload)
+    if change.get("new"):
+        subscriber_index.add(change["new"])
+    old = change.get("old")
+    return old if old and old != change.get("new") else None
+
+
+async def _discard_removed(conn, numbers: set):
+    # Un même numéro peut appartenir à plusieurs comptes : on ne le retire que s'il n'existe plus
+    for number in numbers:
+        cur = await conn.execute("SELECT 1 FROM users WHERE real_number = %s LIMIT 1", (number,))
+        if not await cur.fetchone():
+            subscriber_index.discard(number)
+
+
+async def _listen_forever():
+    max_staleness = subscriber_index.max_staleness
+    reload_every = float(os.getenv("SUBSCRIBER_CACHE_RELOAD_INTERVAL", "3600"))
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(os.getenv("DATABASE_URL"), autocommit=True)
+            async with conn:
+                # LISTEN avant le chargement complet : aucune modification ne peut passer entre les deux
+                await conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                await _full_reload(conn)
+                last_reload = time.monotonic()
+                while True:
+                    # Réveil au moins deux fois par fenêtre de staleness pour confirmer que la connexion est vivante.
+                    # notifies() garde le verrou de la connexion pendant l'itération : aucune requête possible ici,
+                    # les retraits (qui interrogent la base) sont vérifiés après la sortie de la boucle
+                    removed = set()
+                    async for notify in conn.notifies(timeout=max_staleness / 2):
+                        old = _apply_change(notify.payload)
+                        if old:
+                            removed.add(old)
+                    await _discard_removed(conn, removed)
+                    await conn.execute("SELECT 1")
+                    subscriber_index.mark_synced()
+                    if time.monotonic() - last_reload >= reload_every:
+                        await _full_reload(conn)
+                        last_reload = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # En cas de coupure, verify_user_exists repasse sur la base dès que la staleness est dépassée
+            logging.error(f"Synchronisation de l'index abonnés interrompue : {str(e)}")
+            await asyncio.sleep(5)
+
+
+_listener_task: asyncio.Task | None = None
+
+
+def start_subscriber_index():
+    """Démarre la tâche de synchronisation (appelé dans le lifespan de l'application)"""
+    global _listener_task
+    if os.getenv("SUBSCRIBER_CACHE_ENABLED", "1") == "1" and _listener_task is None:
+        _listener_task = asyncio.create_task(_listen_forever())
+
+
+async def stop_subscriber_index():
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
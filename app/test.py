@@ -1,5 +1,25 @@
-from securite import MaskRequest
+from securite import MaskRequest, HashingPool, hash_password, verify_password, create_jwt_token, decode_token
+from securite import encrypt_mappings, decrypt_mappings, get_cipher_suite, _mapping_ciphers
+from cryptography.fernet import Fernet
+import json
+from fastapi import HTTPException
 from pydantic import ValidationError
+import asyncio
+import os
+from datetime import datetime, timedelta
+from psycopg_pool import AsyncConnectionPool
+from allocation import claim_proxy
+from subscribers import SubscriberIndex
+from simulation import CallScheduler
+from ratelimit import SharedTokenBuckets
+from admission import AdmissionController
+from idempotency import pair_hash, get_by_idempotency_key, remember
+from metrics import Counter, Histogram, StageTimer, render_metrics
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from insert_users import validate  # noqa: E402
+import tempfile
+import pytest
 def test_maskrequest_identical_numbers():
     try:
         # Créez une instance avec caller_real et callee_real identiques
@@ -10,5 +30,258 @@ def test_maskrequest_identical_numbers():
         print("Test réussi : ValidationError levée")
         print(e)
 
+#------------------ allocation concurrente : aucun numéro ne doit être assigné deux fois
+# Nécessite une base PostgreSQL jetable (TEST_DATABASE_URL) ; les tables sont créées dans un schéma dédié
+async def _claim_concurrently(url: str, pool_size: int, requests: int):
+    async with AsyncConnectionPool(url, min_size=20, max_size=20, kwargs={"options": "-c search_path=alloc_test"}) as pool:
+        async with pool.connection() as conn:
+            await conn.execute("DROP SCHEMA IF EXISTS alloc_test CASCADE; CREATE SCHEMA alloc_test;")
+            await conn.execute("""
+                CREATE TABLE proxy_pool (
+                    id SERIAL PRIMARY KEY, proxy_number VARCHAR(20) UNIQUE NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'available', assigned_to BYTEA, call_id VARCHAR(36),
+                    expires_at TIMESTAMP, rand_key DOUBLE PRECISION NOT NULL DEFAULT random(), pair_hash BYTEA);
+                CREATE INDEX ON proxy_pool (rand_key) WHERE status = 'available';""")
+            await conn.execute(
+                "INSERT INTO proxy_pool (proxy_number) SELECT '+21600' || lpad(g::text, 6, '0') FROM generate_series(1, %s) g",
+                (pool_size,))
+
+        async def one_claim(i):
+            async with pool.connection() as conn:
+                return await claim_proxy(conn, f"mapping-{i}".encode(), f"call-{i}", datetime.now() + timedelta(hours=24))
+
+        claimed = await asyncio.gather(*(one_claim(i) for i in range(requests)))
+
+        async with pool.connection() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM proxy_pool WHERE status = 'assigned'")
+            assigned = (await cur.fetchone())[0]
+            await conn.execute("DROP SCHEMA alloc_test CASCADE")
+    return claimed, assigned
+
+def test_claim_proxy_no_double_assignment():
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL non défini")
+    claimed, assigned = asyncio.run(_claim_concurrently(url, pool_size=50, requests=200))
+    numbers = [p for p in claimed if p is not None]
+    assert len(numbers) == len(set(numbers)) == assigned == 50, \
+        f"{len(numbers)} réservations, {len(set(numbers))} distinctes, {assigned} en base"
+    print("Test réussi : 50 numéros assignés une seule fois, 150 requêtes sans numéro")
+
+#------------------ index des abonnés : recherche, ajout/retrait, numéros hors format ignorés
+def test_subscriber_index():
+    index = SubscriberIndex()
+    index.replace(["+21692111111", "+21696222222", "+2197444444"])
+    index.discard("+21696222222")
+    assert "+21692111111" in index
+    assert "+21696222222" not in index
+    assert "+2197444444" not in index
+    assert index.count == 1
+    print("Test réussi : index abonnés cohérent")
+
+#------------------ pool bcrypt : au-delà de la capacité, refus immédiat en 503
+async def _saturate_hashing_pool():
+    pool = HashingPool()
+    pool.workers, pool.max_queue = 1, 1
+    hashed = hash_password("password123")
+    results = await asyncio.gather(*(pool.run(verify_password, "password123", hashed) for _ in range(3)), return_exceptions=True)
+    pool.shutdown()
+    return results
+
+def test_hashing_pool_rejects_overflow():
+    results = asyncio.run(_saturate_hashing_pool())
+    rejected = [r for r in results if isinstance(r, HTTPException) and r.status_code == 503]
+    assert results.count(True) == 2 and len(rejected) == 1, results
+    print("Test réussi : 2 vérifications exécutées, 1 refusée en 503")
+
+#------------------ cache des tokens vérifiés : un même token n'est décodé qu'une fois
+def test_token_cache_reuses_claims():
+    token = create_jwt_token("rayen", "user")
+    first, second = decode_token(token), decode_token(token)
+    assert first is second, "token décodé à nouveau"
+    assert first["sub"] == "rayen" and first["scope"] == "user"
+    print("Test réussi : claims servis depuis le cache")
+
+#------------------ ordonnanceur de simulation : 3 événements par appel, capacité bornée
+async def _run_scheduler():
+    events = []
+    scheduler = CallScheduler(sink=events.append, max_calls=2)
+    scheduler.start()
+    accepted = [scheduler.schedule(f"call-{i}", f"+2160000000{i}") for i in range(3)]
+
+    async def wait_events():
+        while len(events) < 6:
+            await asyncio.sleep(0.5)
+
+    try:
+        # 3 événements par appel accepté, espacés de 1 à 3 s : 9 s au plus
+        await asyncio.wait_for(wait_events(), timeout=15)
+    finally:
+        await scheduler.stop()
+    return accepted, events
+
+def test_call_scheduler():
+    accepted, events = asyncio.run(_run_scheduler())
+    call0 = [e["event"] for e in events if e["call_id"] == "call-0"]
+    assert accepted == [True, True, False], accepted
+    assert call0 == ["RINGING", "ANSWERED", "HANGUP"], events
+    print("Test réussi : cycle de vie simulé sans thread, 3e appel refusé")
+
+#------------------ mappings chiffrés : format compact v1 et anciens jetons Fernet
+def test_mapping_formats():
+    mapping = {"caller_real": "+21692111111", "callee_real": "+21696222222"}
+    compact = encrypt_mappings([mapping, mapping])
+    legacy = get_cipher_suite().encrypt(json.dumps(mapping).encode())
+    decrypted = decrypt_mappings(compact + [legacy])
+    assert all(len(blob) == 38 for blob in compact) and compact[0] != compact[1]
+    assert decrypted == [mapping] * 3, decrypted
+    print("Test réussi : format compact de 38 octets, anciens mappings Fernet lisibles")
+
+#------------------ rotation de SECRET_KEY : l'ancienne clé passée dans OLD_SECRET_KEYS relit les mappings compacts
+def test_mapping_key_rotation(monkeypatch):
+    mapping = {"caller_real": "+21692111111", "callee_real": "+21696222222"}
+    blob = encrypt_mappings([mapping])[0]
+    monkeypatch.setenv("OLD_SECRET_KEYS", os.environ["SECRET_KEY"])
+    monkeypatch.setenv("SECRET_KEY", Fernet.generate_key().decode())
+    _mapping_ciphers.cache_clear()
+    try:
+        assert decrypt_mappings([blob, encrypt_mappings([mapping])[0]]) == [mapping] * 2
+    finally:
+        monkeypatch.undo()
+        _mapping_ciphers.cache_clear()
+    print("Test réussi : mappings existants lisibles après rotation de SECRET_KEY")
+
+#------------------ rate limiting partagé : capacité respectée, quotas indépendants par clé
+def test_shared_token_buckets():
+    with tempfile.TemporaryDirectory() as directory:
+        buckets = SharedTokenBuckets(path=os.path.join(directory, "ratelimit"), groups=64)
+        first = [buckets.acquire("login:ip:10.0.0.1", 5, 60) for _ in range(6)]
+        other = buckets.acquire("login:ip:10.0.0.2", 5, 60)
+    assert first[:5] == [0.0] * 5 and first[5] > 0, first
+    assert other == 0.0, other
+    print("Test réussi : 5 requêtes acceptées, la 6e refusée, autre IP non affectée")
+
+#------------------ contrôle d'admission : file à priorité (admin d'abord), délestage 503 au-delà de la file
+async def _run_admission():
+    controller = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=0.5, target_latency=1)
+    await controller.acquire()
+    order = []
+
+    async def waiter(name, priority):
+        await controller.acquire(priority)
+        order.append(name)
+        controller.release(0.01)
+
+    waiters = [asyncio.create_task(waiter("user", 1)), asyncio.create_task(waiter("admin", 0))]
+    await asyncio.sleep(0)
+    try:
+        await controller.acquire()  # file pleine
+        shed = None
+    except HTTPException as e:
+        shed = (e.status_code, e.headers.get("Retry-After"))
+    controller.release(0.01)
+    await asyncio.gather(*waiters)
+    return order, shed, controller.in_flight
+
+def test_admission_controller():
+    order, shed, in_flight = asyncio.run(_run_admission())
+    assert order == ["admin", "user"], order
+    assert shed == (503, "1"), shed
+    assert in_flight == 0, in_flight
+    print("Test réussi : admin servi avant user, 503 avec Retry-After quand la file est pleine")
+
+#------------------ Idempotency-Key : même réponse pour le même couple, 422 si la clé est réutilisée pour un autre
+def test_idempotency_key_bound_to_pair():
+    pair, other = pair_hash("+21692111111", "+21696222222"), pair_hash("+21692111111", "+21697333333")
+    response = {"success": True, "proxy_number": "+21600000001"}
+    remember(pair, response, datetime.now() + timedelta(hours=1), "rayen", "cle-1")
+    assert get_by_idempotency_key("rayen", "cle-1", pair) is response
+    with pytest.raises(HTTPException) as error:
+        get_by_idempotency_key("rayen", "cle-1", other)
+    assert error.value.status_code == 422
+    print("Test réussi : clé rejouée pour le même couple, 422 pour un autre couple")
+
+#------------------ export Prometheus : seaux cumulés (bornes incluses), +Inf, _sum, _count, labels échappés, StageTimer
+def test_metrics_exposition():
+    histogram = Histogram("test_latency_seconds", "Histogramme de test", ("handler",), buckets=(0.1, 0.25, 0.5))
+    for value in (0.05, 0.1, 0.3, 20):  # entre deux bornes, sur une borne, au-delà de la dernière
+        histogram.observe(value, "mask_call")
+    Counter("test_requests_total", "Compteur de test", ("path",)).inc('/a"b\\c\nd')
+    timer = StageTimer("test_handler")
+    timer.mark("verify_users")
+    timer.done()
+    lines_all = dict(line.rsplit(" ", 1) for line in render_metrics().splitlines() if not line.startswith("#"))
+    lines = {name: value for name, value in lines_all.items() if name.startswith("test_")}
+    assert lines['test_latency_seconds_bucket{handler="mask_call",le="0.1"}'] == "2"
+    assert lines['test_latency_seconds_bucket{handler="mask_call",le="0.25"}'] == "2"
+    assert lines['test_latency_seconds_bucket{handler="mask_call",le="0.5"}'] == "3"
+    assert lines['test_latency_seconds_bucket{handler="mask_call",le="+Inf"}'] == "4"
+    assert float(lines['test_latency_seconds_sum{handler="mask_call"}']) == pytest.approx(20.45)
+    assert lines['test_latency_seconds_count{handler="mask_call"}'] == "4"
+    assert lines['test_requests_total{path="/a\\"b\\\\c\\nd"}'] == "1"
+    assert lines_all['api_stage_seconds_count{handler="test_handler",stage="verify_users"}'] == "1"
+    assert lines_all['api_handler_seconds_count{handler="test_handler"}'] == "1"
+    print("Test réussi : export Prometheus conforme (seaux cumulés, +Inf, _sum, _count, échappement)")
+
+#------------------ import des abonnés : mêmes règles que l'API (numéro, username, mot de passe, scope)
+def test_insert_users_validate():
+    valid = {"username": "rayen", "password": "password120", "real_number": "+21692444444", "scope": "user"}
+    assert validate(valid) is None
+    assert "numéro invalide" in validate({**valid, "real_number": "+2197444444"})  # cas du jeu d'essai
+    assert "username invalide" in validate({**valid, "username": "a" * 51})
+    assert "username invalide" in validate({**valid, "username": "ray-en"})
+    assert "mot de passe invalide" in validate({**valid, "password": "password"})
+    assert "scope inconnu" in validate({**valid, "scope": "root"})
+    assert validate({**valid, "scope": "switch"}) is None
+    print("Test réussi : lignes invalides rejetées avant le COPY")
+
+#------------------ pool épuisé : couple déjà masqué et clé rejouée servis, nouvelle allocation délestée
+async def _mask_call_with_exhausted_pool():
+    import time
+    import uuid
+    import httpx
+    import main
+    from pool_stats import pool_stats
+    from subscribers import subscriber_index
+    from admission import admission
+    caller, callee = "+21692111111", "+21696222222"
+    subscriber_index.replace([caller, callee])
+    pool_stats.snapshot = {"total": 10, "available": 0, "assigned": 10, "expired": 0, "expired_capped": False,
+                           "by_prefix": {}}
+    pool_stats.refreshed_at = time.monotonic()
+    response = {"success": True, "call_id": "call-1", "proxy_number": "+21600000001",
+                "expires_at": (datetime.now() + timedelta(hours=1)).isoformat(), "message": "test"}
+    remember(pair_hash(caller, callee), response, datetime.now() + timedelta(hours=1))
+    token = create_jwt_token(f"test-{uuid.uuid4().hex[:8]}", "user")  # quota de rate limiting neuf
+    headers = {"Authorization": f"Bearer {token}", "Idempotency-Key": "cle-2"}
+    body = {"caller_real": caller, "callee_real": callee}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        first = await client.post("/mask/call", json=body, headers=headers)   # couple déjà masqué
+        replay = await client.post("/mask/call", json=body, headers=headers)  # même Idempotency-Key
+    try:
+        admission.check_pool(1)
+        shed = None
+    except HTTPException as e:
+        shed = (e.status_code, e.headers.get("Retry-After"))
+    pool_stats.snapshot = None
+    return first, replay, shed
+
+def test_exhausted_pool_still_serves_existing_pairs():
+    first, replay, shed = asyncio.run(_mask_call_with_exhausted_pool())
+    assert first.status_code == 200 and first.json()["proxy_number"] == "+21600000001", first.text
+    assert replay.status_code == 200 and replay.json() == first.json(), replay.text
+    assert shed == (503, "30"), shed
+    print("Test réussi : pool épuisé, couple existant et clé rejouée servis, nouvelle allocation en 503")
+
 if __name__ == "__main__":
-    test_maskrequest_identical_numbers()
\ No newline at end of file
+    # Exécution directe (sans pytest) : un test ignoré est signalé, un échec interrompt l'exécution
+    for test in (
+        test_maskrequest_identical_numbers, test_claim_proxy_no_double_assignment, test_subscriber_index,
+        test_hashing_pool_rejects_overflow, test_token_cache_reuses_claims, test_call_scheduler,
+        test_mapping_formats, test_shared_token_buckets, test_admission_controller, test_idempotency_key_bound_to_pair,
+        test_metrics_exposition, test_insert_users_validate, test_exhausted_pool_still_serves_existing_pairs,
+    ):
+        try:
+            test()
+        except pytest.skip.Exception as e:
+            print(f"Test ignoré ({test.__name__}) : {e.msg}")
@@ -0,0 +1,38 @@
+"""Micro-benchmarks des fonctions du chemin critique (aucune base de données nécessaire).
+
+    python benchmarks/bench_micro.py
+
+Mesure le coût unitaire de encrypt_mapping/decrypt_mapping (et d'un lot de 1000 mappings), du décodage JWT
+(signature vérifiée et servi par le cache de tokens) et de la validation de MaskRequest.
+SECRET_KEY et JWT_SECRET_KEY doivent être définis.
+"""
+import os
+import sys
+import timeit
+
+import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import securite  # noqa: E402
+from securite import MaskRequest, create_jwt_token, decode_token, encrypt_mapping, decrypt_mapping, encrypt_mappings  # noqa: E402
+
+
+def bench(name, func, number):
+    # Meilleur de 5 répétitions : moins sensible au bruit de la machine
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    per_call = best / number
+    print(f"{name:<28} {per_call * 1e6:9.2f} µs/appel  {1 / per_call:12.0f} appels/s")
+
+
+if __name__ == "__main__":
+    mapping = {"caller_real": "+21692111111", "callee_real": "+21696222222"}
+    encrypted = encrypt_mapping(mapping)
+    token = create_jwt_token("khairia", "admin")
+    body = {"caller_real": "+21692111111", "callee_real": "+21696222222"}
+
+    bench("encrypt_mapping", lambda: encrypt_mapping(mapping), 5000)
+    bench("decrypt_mapping", lambda: decrypt_mapping(encrypted), 5000)
+    bench("encrypt_mappings (x1000)", lambda: encrypt_mappings([mapping] * 1000), 20)
+    bench("jwt.decode (signature)", lambda: jwt.decode(token, securite.JWT_SECRET_KEY, algorithms=["HS256"]), 20000)
+    bench("decode_token (cache)", lambda: decode_token(token), 200000)
+    bench("MaskRequest validation", lambda: MaskRequest(**body), 50000)
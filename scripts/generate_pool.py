@@ -1,32 +1,104 @@
+import io
 import os
-from faker import Faker
+import math
+import random
+import argparse
 import psycopg2
 from dotenv import load_dotenv
 
 load_dotenv()
-fake = Faker()
+
+# Approvisionnement du pool de numéros proxy (+21600XXXXXX) :
+#   - numéros uniques sans tirage ni collision : permutation affine i -> (a*i + b) mod n de la plage, fixée par --seed
+#   - insertion en flux par COPY, par blocs (une transaction par bloc)
+#   - reprise : la position atteinte dans la permutation est enregistrée dans pool_provisioning à chaque bloc
+#
+#   python scripts/generate_pool.py --size 5000               # 5000 nouveaux numéros
+#   python scripts/generate_pool.py --target-available 20000  # complète jusqu'à 20000 numéros disponibles
+#   python scripts/generate_pool.py --all                     # toute la plage (1M numéros par défaut)
+
+PREFIX = "+21600"
+POOL_SIZE = 200  # nombre de numéros ajoutés par défaut
+
+parser = argparse.ArgumentParser(description="Approvisionne proxy_pool en numéros uniques via COPY")
+parser.add_argument("--start", type=int, default=0, help="début de la plage (suffixe à 6 chiffres)")
+parser.add_argument("--end", type=int, default=1_000_000, help="fin de la plage (exclue)")
+parser.add_argument("--seed", type=int, default=216, help="graine de la permutation (même graine = même ordre, reprise possible)")
+parser.add_argument("--chunk-size", type=int, default=50_000)
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument("--size", type=int, default=POOL_SIZE, help="nombre de numéros à ajouter")
+mode.add_argument("--target-available", type=int, help="complète le pool jusqu'à ce nombre de numéros disponibles")
+mode.add_argument("--all", action="store_true", help="parcourt toute la plage")
+args = parser.parse_args()
+
+span = args.end - args.start
+if span <= 0 or args.end > 1_000_000 or args.start < 0:
+    parser.error("plage invalide : 0 <= start < end <= 1000000")
+
+# Paramètres de la permutation dérivés de la graine : a premier avec span => bijection sur [0, span)
+rng = random.Random(args.seed)
+a = rng.randrange(1, span) if span > 1 else 1
+while math.gcd(a, span) != 1:
+    a = rng.randrange(1, span)
+b = rng.randrange(span)
+
+
+def number_at(position: int) -> str:
+    return f"{PREFIX}{args.start + (a * position + b) % span:06d}"
+
 
 conn = psycopg2.connect(os.getenv('DATABASE_URL'))
 cur = conn.cursor()
 
-POOL_SIZE = 200
-numbers = []
-for _ in range(POOL_SIZE):
-         num = f"+21600{fake.random_number(digits=6):06d}"
-         numbers.append((num,))
+cur.execute("""
+    CREATE TABLE IF NOT EXISTS pool_provisioning (
+        seed INTEGER NOT NULL, range_start INTEGER NOT NULL, range_end INTEGER NOT NULL,
+        position BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (seed, range_start, range_end)
+    );
+""")
+cur.execute("""
+    INSERT INTO pool_provisioning (seed, range_start, range_end) VALUES (%s, %s, %s)
+    ON CONFLICT DO NOTHING;
+""", (args.seed, args.start, args.end))
+cur.execute("SELECT position FROM pool_provisioning WHERE seed = %s AND range_start = %s AND range_end = %s;",
+            (args.seed, args.start, args.end))
+position = cur.fetchone()[0]
+conn.commit()
 
-cur.executemany("""
-         INSERT INTO proxy_pool (proxy_number, status) 
-         VALUES (%s, 'available') 
-         ON CONFLICT (proxy_number) DO NOTHING;
-     """, numbers)
+# Nombre de numéros à ajouter selon le mode
+if args.all:
+    wanted = span - position
+elif args.target_available is not None:
+    cur.execute("SELECT COALESCE(SUM(count), 0) FROM proxy_pool_stats WHERE status = 'available';")
+    wanted = max(0, args.target_available - int(cur.fetchone()[0]))
+else:
+    wanted = args.size
 
-conn.commit()
+cur.execute("CREATE TEMP TABLE pool_staging (proxy_number VARCHAR(20)) ON COMMIT DELETE ROWS;")
+
+inserted = skipped = 0
+while inserted < wanted and position < span:
+    count = min(args.chunk_size, wanted - inserted, span - position)
+    buffer = io.StringIO("".join(number_at(p) + "\n" for p in range(position, position + count)))
+    cur.copy_expert("COPY pool_staging (proxy_number) FROM STDIN", buffer)
+    # Les numéros déjà présents (ancien approvisionnement, créations à la volée) sont ignorés et comptés
+    cur.execute("""
+        INSERT INTO proxy_pool (proxy_number, status)
+        SELECT proxy_number, 'available' FROM pool_staging
+        ON CONFLICT (proxy_number) DO NOTHING;
+    """)
+    inserted += cur.rowcount
+    skipped += count - cur.rowcount
+    position += count
+    cur.execute("UPDATE pool_provisioning SET position = %s WHERE seed = %s AND range_start = %s AND range_end = %s;",
+                (position, args.seed, args.start, args.end))
+    conn.commit()  # bloc et position de reprise validés ensemble
+    print(f"  {position}/{span} positions parcourues, {inserted} numéros ajoutés")
 
-cur.execute("SELECT COUNT(*) FROM proxy_pool WHERE status = 'available';")
-inserted = cur.fetchone()[0]
-print(f"Pool rempli ! {inserted} numéros disponibles insérés (total possible {POOL_SIZE}).")
+if inserted < wanted:
+    print(f"Plage épuisée : {wanted - inserted} numéros manquants (élargissez --start/--end ou changez de plage).")
+print(f"Pool rempli ! {inserted} numéros ajoutés, {skipped} déjà présents ignorés.")
 
 cur.close()
 conn.close()
-     
\ No newline at end of file
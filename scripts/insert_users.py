@@ -1,52 +1,132 @@
+import io
+import os
+import re
+import csv
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import psycopg2
 from dotenv import load_dotenv
-import os
 import bcrypt  # securiser les mdp
 
-load_dotenv()
+# Import en masse des abonnés depuis un fichier CSV ou JSONL (colonnes username, password, real_number, scope) :
+#   scope : user (défaut), admin, ou switch pour le compte technique du commutateur
+#   - hachage bcrypt réparti sur tous les cœurs (pool de processus)
+#   - chargement par COPY dans une table temporaire puis upsert par lot (une transaction par lot)
+#
+#   python scripts/insert_users.py abonnes.csv --batch-size 5000
+#   python scripts/insert_users.py                 # jeu d'essai scripts/users_sample.jsonl
+
+PHONE_PATTERN = re.compile(r'^\+216\d{8}$')  # Même règle que MaskRequest.validate_phone (app/securite.py)
+USERNAME_PATTERN = re.compile(r'^[a-zA-Z0-9_]{3,50}$')  # Même règle que LoginRequest.validate_username
+SCOPES = {"user", "admin", "switch"}  # "switch" : compte du commutateur (GET /route/{proxy_number})
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users_sample.jsonl")
+
 
 def get_db_connection():
     return psycopg2.connect(os.getenv('DATABASE_URL'))
 
-users_data = [
-    {"username": "khairia", "password": "adminpass123", "real_number": "+21692111111", "scope": "admin"},
-    {"username": "fawzi", "password": "adminpass456", "real_number": "+21692222222", "scope": "admin"},
-    {"username": "khalil", "password": "adminpass789", "real_number": "+21692333333", "scope": "admin"},
-    {"username": "rayen", "password": "password120", "real_number": "+21692444444", "scope": "user"},
-    {"username": "ahmed", "password": "password121", "real_number": "+21692555555", "scope": "user"},
-    {"username": "aya", "password": "password122", "real_number": "+21696111111", "scope": "user"},
-    {"username": "hanin", "password": "password123", "real_number": "+21696222222", "scope": "user"},
-    {"username": "ranim", "password": "password124", "real_number": "+21696333333", "scope": "user"},
-    {"username": "maram", "password": "password125", "real_number": "+21696444444", "scope": "user"},
-    {"username": "ali", "password": "password126", "real_number": "+21696555555", "scope": "user"},   
-    {"username": "omar", "password": "password127", "real_number": "+21697111111", "scope": "user"},
-    {"username": "youssef", "password": "password128", "real_number": "+21697222222", "scope": "user"},
-    {"username": "achref", "password": "password129", "real_number": "+21697333333", "scope": "user"},
-    {"username": "oumayma", "password": "userpass121", "real_number": "+2197444444", "scope": "user"},
-    {"username": "imen", "password": "userpass122", "real_number": "+21697555555", "scope": "user"},
-    {"username": "rouaida", "password": "userpass123", "real_number": "+21698111111", "scope": "user"},
-    {"username": "tarnim", "password": "userpass124", "real_number": "+21698222222", "scope": "user"},
-    {"username": "darine", "password": "userpass125", "real_number": "+21698333333", "scope": "user"},
-    {"username": "ghada", "password": "userpass126", "real_number": "+21698444444", "scope": "user"},
-    {"username": "siwar", "password": "userpass127", "real_number": "+21698555555", "scope": "user"},
-
-]
-
-try:
+
+def read_users(path):
+    """Lit le fichier ligne par ligne (pas de chargement complet en mémoire) ; produit (n° de ligne, dict)"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line_no, line in enumerate(f, start=1):
+                if line.strip():
+                    yield line_no, json.loads(line)
+        else:
+            for line_no, row in enumerate(csv.DictReader(f), start=2):
+                yield line_no, row
+
+
+def validate(user) -> str | None:
+    """Retourne la raison du rejet, ou None si la ligne est valide"""
+    if not user.get("username") or not user.get("password"):
+        return "username ou password manquant"
+    # Un compte que /auth/login refuserait toujours n'est pas importé (et username > 50 caractères ferait échouer le COPY)
+    if not USERNAME_PATTERN.match(user["username"]):
+        return f"username invalide {user['username']!r} (3 à 50 caractères : lettres, chiffres, _)"
+    if len(user["password"]) < 8 or not re.search(r'\d', user["password"]):  # LoginRequest.validate_password
+        return "mot de passe invalide (minimum 8 caractères avec des chiffres)"
+    if not PHONE_PATTERN.match(user.get("real_number") or ""):
+        return f"numéro invalide {user.get('real_number')!r}"
+    if (user.get("scope") or "user") not in SCOPES:
+        return f"scope inconnu {user.get('scope')!r}"
+    return None
+
+
+def hash_password(args) -> str:
+    password, rounds = args
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def load_batch(conn, batch, hashes):
+    cur = conn.cursor()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for seq, (user, hashed) in enumerate(zip(batch, hashes)):
+        writer.writerow((seq, user["username"], hashed, user["real_number"], user.get("scope") or "user"))
+    buffer.seek(0)
+    cur.copy_expert("COPY users_staging (seq, username, password, real_number, scope) FROM STDIN WITH (FORMAT csv)", buffer)
+    # Un username présent plusieurs fois dans le lot : la dernière occurrence l'emporte
+    cur.execute("""
+        INSERT INTO users (username, password, real_number, scope)
+        SELECT DISTINCT ON (username) username, password, real_number, scope
+        FROM users_staging ORDER BY username, seq DESC
+        ON CONFLICT (username) DO UPDATE
+        SET password = EXCLUDED.password, real_number = EXCLUDED.real_number, scope = EXCLUDED.scope;
+    """)
+    conn.commit()  # vide aussi users_staging (ON COMMIT DELETE ROWS)
+    cur.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Import en masse des abonnés (CSV ou JSONL)")
+    parser.add_argument("file", nargs="?", default=SAMPLE_FILE)
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--rounds", type=int, default=12, help="coût bcrypt (12 = valeur par défaut de bcrypt.gensalt)")
+    args = parser.parse_args()
+
     conn = get_db_connection()
     cur = conn.cursor()
-    
-    for user in users_data:
-        hashed_password = bcrypt.hashpw(user['password'].encode(), bcrypt.gensalt()).decode()  # Hashage sécurisé
-        cur.execute("""
-            INSERT INTO users (username, password, real_number, scope)
-            VALUES (%s, %s, %s, %s);
-        """, (user['username'], hashed_password, user['real_number'], user['scope']))
-    
+    cur.execute("""
+        CREATE TEMP TABLE users_staging (
+            seq INTEGER, username VARCHAR(50), password TEXT, real_number VARCHAR(20), scope VARCHAR(20)
+        ) ON COMMIT DELETE ROWS;
+    """)
     conn.commit()
+
+    started = time.perf_counter()
+    loaded = rejected = 0
+    rows = read_users(args.file)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        while True:
+            chunk = list(itertools.islice(rows, args.batch_size))
+            if not chunk:
+                break
+            batch = []
+            for line_no, user in chunk:
+                reason = validate(user)
+                if reason:
+                    rejected += 1
+                    print(f"Ligne {line_no} rejetée ({user.get('username')}) : {reason}")
+                else:
+                    batch.append(user)
+            if not batch:
+                continue
+            chunksize = max(1, len(batch) // (args.workers * 4))
+            hashes = list(executor.map(hash_password, [(u["password"], args.rounds) for u in batch], chunksize=chunksize))
+            load_batch(conn, batch, hashes)
+            loaded += len(batch)
+            elapsed = time.perf_counter() - started
+            print(f"  {loaded} utilisateurs chargés ({loaded / elapsed:.0f}/s)")
+
+    elapsed = time.perf_counter() - started
     cur.close()
     conn.close()
-    print("Utilisateurs insérés avec succès !")
-
-except Exception as e:
-    print(f"Erreur : {e}")
\ No newline at end of file
+    print(f"Utilisateurs insérés avec succès ! {loaded} chargés, {rejected} rejetés en {elapsed:.1f} s "
+          f"({loaded / elapsed if elapsed else 0:.0f} utilisateurs/s, {args.workers} workers).")
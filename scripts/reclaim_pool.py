@@ -0,0 +1,33 @@
+import os
+import sys
+import argparse
+from datetime import datetime
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Même requête que l'application (app/pool_sql.py, utilisée par app/reaper.py) : lots bornés, une transaction par lot, SKIP LOCKED
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from pool_sql import RELEASE_SQL  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Remet dans le pool les numéros proxy dont l'assignation a expiré")
+parser.add_argument("--batch-size", type=int, default=500)
+args = parser.parse_args()
+
+conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+cur = conn.cursor()
+
+recycled = 0
+while True:
+    cur.execute(RELEASE_SQL, {"now": datetime.now(), "batch_size": args.batch_size})
+    batch = cur.rowcount
+    conn.commit()  # libère les verrous du lot avant le suivant
+    recycled += batch
+    if batch < args.batch_size:
+        break
+
+print(f"Recyclage terminé ! {recycled} numéros remis à disposition.")
+
+cur.close()
+conn.close()
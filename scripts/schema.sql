@@ -0,0 +1,125 @@
+-- Schéma de la base de l'API de masquage d'appels.
+-- Toutes les instructions sont idempotentes : le fichier peut être rejoué sur une base existante
+--   psql "$DATABASE_URL" -f scripts/schema.sql
+
+CREATE TABLE IF NOT EXISTS users (
+    id          SERIAL PRIMARY KEY,
+    username    VARCHAR(50) NOT NULL,
+    password    TEXT NOT NULL,
+    real_number VARCHAR(20) NOT NULL,
+    scope       VARCHAR(20) NOT NULL DEFAULT 'user'
+);
+
+CREATE TABLE IF NOT EXISTS proxy_pool (
+    id           SERIAL PRIMARY KEY,
+    proxy_number VARCHAR(20) UNIQUE NOT NULL,
+    status       VARCHAR(20) NOT NULL DEFAULT 'available',
+    assigned_to  TEXT,
+    call_id      VARCHAR(36),
+    expires_at   TIMESTAMP
+);
+
+------------------------------ Allocation sans contention (app/allocation.py) ------------------------------
+-- Clé aléatoire fixée à l'insertion : remplace ORDER BY RANDOM() par un parcours d'index borné
+ALTER TABLE proxy_pool ADD COLUMN IF NOT EXISTS rand_key DOUBLE PRECISION NOT NULL DEFAULT random();
+-- Index partiel : seuls les numéros disponibles y figurent, il reste petit quand le pool se remplit
+CREATE INDEX IF NOT EXISTS proxy_pool_available_rand_idx ON proxy_pool (rand_key) WHERE status = 'available';
+
+------------------------------ Index des abonnés en mémoire (app/subscribers.py) ------------------------------
+CREATE INDEX IF NOT EXISTS users_real_number_idx ON users (real_number);
+
+-- Chaque modification de users est publiée sur le canal users_changed : {"old": ..., "new": ...}
+CREATE OR REPLACE FUNCTION users_notify_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('users_changed', json_build_object(
+        'old', CASE WHEN TG_OP IN ('UPDATE', 'DELETE') THEN OLD.real_number END,
+        'new', CASE WHEN TG_OP IN ('INSERT', 'UPDATE') THEN NEW.real_number END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_notify_change ON users;
+CREATE TRIGGER users_notify_change
+    AFTER INSERT OR DELETE OR UPDATE OF real_number ON users
+    FOR EACH ROW EXECUTE FUNCTION users_notify_change();
+
+------------------------------ Recyclage des numéros expirés (app/reaper.py, scripts/reclaim_pool.py) ------------------------------
+CREATE INDEX IF NOT EXISTS proxy_pool_assigned_expires_idx ON proxy_pool (expires_at) WHERE status = 'assigned';
+
+------------------------------ Idempotence par couple appelant/appelé (app/idempotency.py) ------------------------------
+-- HMAC-SHA256 du couple (caller_real, callee_real) : recherche déterministe sans déchiffrer assigned_to
+ALTER TABLE proxy_pool ADD COLUMN IF NOT EXISTS pair_hash BYTEA;
+CREATE INDEX IF NOT EXISTS proxy_pool_pair_hash_idx ON proxy_pool (pair_hash) WHERE status = 'assigned';
+
+------------------------------ Compteurs d'occupation du pool (app/pool_stats.py) ------------------------------
+-- Maintenus dans la même transaction que chaque modification de proxy_pool, par des triggers au niveau instruction
+-- (un seul INSERT ... ON CONFLICT par instruction, même pour un COPY ou une allocation par lot).
+-- Chaque connexion écrit dans son propre shard (pg_backend_pid() % 16) : pas de ligne de compteur unique à se disputer.
+CREATE TABLE IF NOT EXISTS proxy_pool_stats (
+    status VARCHAR(20) NOT NULL,
+    prefix VARCHAR(8)  NOT NULL,
+    shard  SMALLINT    NOT NULL,
+    count  BIGINT      NOT NULL DEFAULT 0,
+    PRIMARY KEY (status, prefix, shard)
+);
+
+CREATE OR REPLACE FUNCTION proxy_pool_stats_apply() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO proxy_pool_stats AS s (status, prefix, shard, count)
+        SELECT status, left(proxy_number, 6), pg_backend_pid() % 16, COUNT(*) FROM new_rows GROUP BY 1, 2
+        ON CONFLICT (status, prefix, shard) DO UPDATE SET count = s.count + EXCLUDED.count;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO proxy_pool_stats AS s (status, prefix, shard, count)
+        SELECT status, left(proxy_number, 6), pg_backend_pid() % 16, -COUNT(*) FROM old_rows GROUP BY 1, 2
+        ON CONFLICT (status, prefix, shard) DO UPDATE SET count = s.count + EXCLUDED.count;
+    ELSE
+        INSERT INTO proxy_pool_stats AS s (status, prefix, shard, count)
+        SELECT status, prefix, pg_backend_pid() % 16, SUM(delta) FROM (
+            SELECT status, left(proxy_number, 6) AS prefix, -1 AS delta FROM old_rows
+            UNION ALL
+            SELECT status, left(proxy_number, 6), 1 FROM new_rows
+        ) changes
+        GROUP BY 1, 2
+        HAVING SUM(delta) <> 0
+        ON CONFLICT (status, prefix, shard) DO UPDATE SET count = s.count + EXCLUDED.count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+BEGIN;
+-- Bloque les écritures le temps d'installer les triggers et d'initialiser les compteurs (cohérence)
+LOCK TABLE proxy_pool IN SHARE ROW EXCLUSIVE MODE;
+DROP TRIGGER IF EXISTS proxy_pool_stats_insert ON proxy_pool;
+DROP TRIGGER IF EXISTS proxy_pool_stats_update ON proxy_pool;
+DROP TRIGGER IF EXISTS proxy_pool_stats_delete ON proxy_pool;
+CREATE TRIGGER proxy_pool_stats_insert AFTER INSERT ON proxy_pool
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION proxy_pool_stats_apply();
+CREATE TRIGGER proxy_pool_stats_update AFTER UPDATE ON proxy_pool
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION proxy_pool_stats_apply();
+CREATE TRIGGER proxy_pool_stats_delete AFTER DELETE ON proxy_pool
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION proxy_pool_stats_apply();
+-- Initialisation à partir du contenu actuel (seulement si les compteurs n'existent pas encore)
+INSERT INTO proxy_pool_stats (status, prefix, shard, count)
+SELECT status, left(proxy_number, 6), 0, COUNT(*) FROM proxy_pool
+WHERE NOT EXISTS (SELECT 1 FROM proxy_pool_stats)
+GROUP BY 1, 2;
+COMMIT;
+
+------------------------------ Import en masse des abonnés (scripts/insert_users.py) ------------------------------
+-- Cible de l'upsert ON CONFLICT (username)
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users (username);
+
+------------------------------ Format compact des mappings chiffrés (app/securite.py) ------------------------------
+-- assigned_to passe de TEXT (jeton Fernet base64) à BYTEA : les anciens jetons sont conservés tels quels (octets ASCII)
+-- et restent déchiffrables ; les nouveaux mappings utilisent le format binaire v1 (38 octets).
+DO $$
+BEGIN
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'proxy_pool' AND column_name = 'assigned_to') = 'text' THEN
+        ALTER TABLE proxy_pool ALTER COLUMN assigned_to TYPE BYTEA USING convert_to(assigned_to, 'UTF8');
+    END IF;
+END;
+$$;